@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 '''
 Encrypt and decrypt files using AES encryption and a common
@@ -85,27 +85,36 @@ warning because the file1.txt output file already exists.
 '''
 import argparse
 import base64
+import binascii
+import bisect
+import errno
 import getpass
+import hashlib
+import heapq
+import hmac
 import inspect
+import json
 import multiprocessing
 import os
+import queue
+import struct
 import subprocess
 import sys
 import threading
-from threading import Thread, Lock, Semaphore
+import time
+from threading import Thread, Lock
 
 try:
+    from cryptography.hazmat.primitives import hashes
     from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
     from cryptography.hazmat.backends import default_backend
 except ImportError as exc:
     print('ERROR: Import failed, you may need to run "pip install cryptography".\n{:>7}{}'.format('', exc))
     sys.exit(1)
 
-try:
-    import Queue as queue  # python 2
-except ImportError:
-    import queue   # python3
-
 
 # ================================================================
 #
@@ -113,9 +122,27 @@ except ImportError:
 #
 # ================================================================
 VERSION = '1.1.3'
+CHUNK_SIZE = 3 * 64 * 1024  # stream chunk size, a multiple of the base64 (3) and AES (16) block sizes
+KDF_COSTS = {  # default KDF costs: PBKDF2 iterations or log2 of the scrypt N parameter
+    'pbkdf2': 600000,
+    'scrypt': 17,
+    }
+OPENSSL_PBKDF2_ITER = 10000  # the openssl default for -pbkdf2
+KDF_MAX_PBKDF2_ITER = 10000000  # the most PBKDF2 iterations that are run, even if a header asks for more
+KDF_MAX_SCRYPT_MEMORY = 1 << 30  # the most memory that scrypt may use: 128 * r * N * p bytes
+MEMORY_FACTOR = 4  # bytes held in memory per byte of a file: input, cipher buffer and base64 output
+SMALL_FILE_SIZE = 64 * 1024  # files up to this size are dispatched to the workers in batches
+BATCH_FILES = 64  # maximum number of files in a batch
+BATCH_BYTES = 1024 * 1024  # maximum number of bytes in a batch
 th_mutex = Lock()  # mutex for thread IO
-th_semaphore = None  # semapthore to limit max active threads
+th_queue = None  # queue of files for the worker threads
 th_abort = False  # If true, abort all threads
+th_journal = None  # progress journal for resumable runs
+th_budget = None  # memory budget for the files that are processed in memory
+th_metrics = None  # per-file latency histograms and event log
+th_manifest = None  # content hashes of the plaintext for the formats that cannot store them
+th_dedup = None  # content addressed store for --dedup
+th_local = threading.local()  # per thread state: the cipher of each worker
 
 
 # ================================================================
@@ -123,6 +150,164 @@ th_abort = False  # If true, abort all threads
 # Classes.
 #
 # ================================================================
+class BufferPool:
+    '''
+    Pool of reusable buffers for the cipher hot path.
+
+    Each thread has its own free list so acquiring and releasing a
+    buffer never takes a lock. Buffers that are larger than max_size
+    are not kept, they are freed when they are released.
+    '''
+    def __init__(self, max_size=16 * 1024 * 1024, max_count=4):
+        '''
+        Initialize the object.
+
+        @param max_size   The largest buffer that is kept.
+        @param max_count  The maximum number of free buffers per thread.
+        '''
+        self.m_local = threading.local()
+        self.m_max_size = max_size
+        self.m_max_count = max_count
+
+    def acquire(self, size):
+        '''
+        Get a buffer that is at least size bytes long.
+        '''
+        free = self._free()
+        for i, buf in enumerate(free):
+            if len(buf) >= size:
+                return free.pop(i)
+        return bytearray(size)
+
+    def release(self, buf):
+        '''
+        Return a buffer to the pool.
+        '''
+        free = self._free()
+        if len(buf) <= self.m_max_size and len(free) < self.m_max_count:
+            free.append(buf)
+
+    def trim(self, max_size):
+        '''
+        Only keep the buffers of up to max_size bytes from now on.
+        The free buffers are not counted in the memory budget, so the
+        pool must not keep the large buffers of the files that are
+        processed in memory.
+        '''
+        self.m_max_size = max_size
+        free = self._free()
+        free[:] = [buf for buf in free if len(buf) <= max_size]
+
+    def _free(self):
+        '''
+        Get the free list for the current thread.
+        '''
+        free = getattr(self.m_local, 'free', None)
+        if free is None:
+            free = self.m_local.free = []
+        return free
+
+
+th_buffers = BufferPool()  # reusable buffers for the cipher hot path
+
+
+def is_kdf_cost_valid(kdf, cost, r=8, p=1):
+    '''
+    Is the cost of a KDF in range?
+
+    The cost of a file that is unlocked comes from its header, so it
+    is checked before the KDF runs to keep a hostile file from
+    demanding unbounded time or memory.
+
+    @param kdf   The KDF: "pbkdf2" or "scrypt".
+    @param cost  The PBKDF2 iterations or log2 of the scrypt N.
+    @param r     The scrypt block size.
+    @param p     The scrypt parallelization.
+    '''
+    if kdf == 'pbkdf2':
+        return 1 <= cost <= KDF_MAX_PBKDF2_ITER
+    if not (1 <= cost <= 30 and r >= 1 and p >= 1):
+        return False
+    return 128 * r * (1 << cost) * p <= KDF_MAX_SCRYPT_MEMORY
+
+
+class MasterKeys:
+    '''
+    Cache of the master keys derived from the password with a strong
+    KDF (PBKDF2 or scrypt).
+
+    The strong KDF is expensive by design so it is run once per run
+    salt rather than once per file. The key for each file is derived
+    from the master key and a random file salt using HKDF, which is
+    cheap. The KDF runs outside of the mutex so that the workers that
+    need the keys of different run salts derive them at the same time,
+    while the workers that need the same key wait for the first one.
+    '''
+    def __init__(self):
+        '''
+        Initialize the object.
+        '''
+        self.m_mutex = Lock()
+        self.m_keys = {}  # (password, kdf, cost, r, p, salt) --> (master key, check value)
+        self.m_pending = {}  # (password, kdf, cost, r, p, salt) --> event set when it is derived
+        self.m_salts = {}  # (kdf, cost) --> run salt used to lock files
+
+    def get(self, password, kdf, cost, r, p, salt):
+        '''
+        Get the master key, deriving it if it is not cached.
+
+        @param password  The password as bytes.
+        @param kdf       The KDF: "pbkdf2" or "scrypt".
+        @param cost      The PBKDF2 iterations or log2 of the scrypt N.
+        @param r         The scrypt block size.
+        @param p         The scrypt parallelization.
+        @param salt      The run salt.
+        @returns the master key and the password check value.
+        @raises ValueError if the cost is out of range.
+        '''
+        if not is_kdf_cost_valid(kdf, cost, r, p):
+            raise ValueError('the kdf cost is out of range')
+        key = (password, kdf, cost, r, p, salt)
+        while True:
+            with self.m_mutex:
+                if key in self.m_keys:
+                    return self.m_keys[key]
+                event = self.m_pending.get(key)
+                if event is None:
+                    event = self.m_pending[key] = threading.Event()
+                    break
+            event.wait()  # another worker is deriving it, or failed to
+        try:
+            backend = default_backend()
+            if kdf == 'pbkdf2':
+                kdfobj = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt,
+                                    iterations=cost, backend=backend)
+            else:
+                kdfobj = Scrypt(salt=salt, length=32, n=1 << cost, r=r, p=p, backend=backend)
+            master = kdfobj.derive(password)
+            check = HKDF(algorithm=hashes.SHA256(), length=8, salt=None,
+                         info=b'lock_files check', backend=backend).derive(master)
+            with self.m_mutex:
+                self.m_keys[key] = (master, check)
+            return master, check
+        finally:
+            with self.m_mutex:
+                del self.m_pending[key]
+            event.set()
+
+    def run_salt(self, kdf, cost):
+        '''
+        Get the run salt that is used to lock files with this KDF.
+        All of the files locked by a run share it so that the
+        master key is only derived once.
+        '''
+        with self.m_mutex:
+            return self.m_salts.setdefault((kdf, cost), os.urandom(16))
+
+
+th_master_keys = MasterKeys()  # master keys derived by this run
+
+
 class AESCipher:
     '''
     Class that provides an object to encrypt or decrypt a string
@@ -130,19 +315,58 @@ class AESCipher:
 
     CITATION: http://joelinoff.com/blog/?p=885
     '''
-    def __init__(self, openssl=False, digest='md5', keylen=32, ivlen=16):
+    def __init__(self, openssl=False, digest='md5', keylen=32, ivlen=16, kdf=None, cost=None, hash=None):
         '''
         Initialize the object.
 
+        If a kdf is specified without openssl, the binary format is
+        used. It stores the KDF parameters and the salts in a header so
+        it can always be decrypted without knowing them in advance:
+
+           offset  size  field
+                0     4  magic: 0x89 "LCK"
+                4     1  version: 1
+                5     1  kdf: 1=pbkdf2 (sha256), 2=scrypt
+                6     4  cost: pbkdf2 iterations or log2 of the scrypt N
+               10     1  scrypt r
+               11     1  scrypt p
+               12     1  content hash: 0=none, 1=sha256, 2=blake2b
+               13    16  run salt for the master key
+               29    16  file salt for the HKDF file key and IV
+               45     8  password check value
+               53     *  AES-CBC ciphertext
+
+        If there is a content hash, the digest of the plaintext is
+        appended to the plaintext before it is padded and encrypted so
+        it is checked when the file is decrypted.
+
+        If a kdf is specified with openssl, the key and IV are derived
+        with PBKDF2 like openssl -pbkdf2 -iter <cost>.
+
         @param openssl  Operate identically to openssl.
         @param width    Width of the MIME encoded lines for encryption. (Not implemented)
         @param digest   The digest used.
         @param keylen   The key length (32-256, 16-128, 8-64).
         @param ivlen    Length of the initialization vector.
+        @param kdf      The strong KDF: None, "pbkdf2" or "scrypt".
+        @param cost     The KDF cost, see KDF_COSTS.
+        @param hash     The content hash: None, "sha256" or "blake2b".
         '''
         self.m_openssl = openssl
         self.m_openssl_prefix = b'Salted__'  # Hardcoded into openssl.
         self.m_openssl_prefix_len = len(self.m_openssl_prefix)
+        self.m_kdf = kdf
+        self.m_kdfs = ['pbkdf2', 'scrypt']  # the index + 1 is stored in the binary header
+        if cost is None and kdf is not None:
+            cost = OPENSSL_PBKDF2_ITER if openssl else KDF_COSTS[kdf]
+        self.m_cost = cost
+        self.m_binary = kdf is not None and not openssl
+        self.m_binary_magic = b'\x89LCK'  # the first byte is never valid base64
+        self.m_binary_format = '>4sBBIBBB16s16s8s'
+        self.m_binary_header_len = struct.calcsize(self.m_binary_format)
+        self.m_hash = hash
+        self.m_hashes = ['sha256', 'blake2b']  # the index + 1 is stored in the binary header
+        self.m_content_digest = None  # the content hash of the last encrypt() or decrypt()
         self.m_digest = getattr(__import__('hashlib', fromlist=[digest]), digest)
         self.m_keylen = keylen
         self.m_ivlen = ivlen
@@ -150,6 +374,8 @@ class AESCipher:
             err('invalid keylen {}, must be 8, 16 or 32'.format(keylen))
         if openssl and ivlen != 16:
             err('invalid ivlen size {}, for openssl compatibility it must be 16'.format(ivlen))
+        if openssl and kdf not in [None, 'pbkdf2']:
+            err('invalid kdf {}, for openssl compatibility it must be pbkdf2'.format(kdf))
 
     def encrypt(self, password, plaintext):
         '''
@@ -161,41 +387,56 @@ class AESCipher:
 
             $ openssl enc -aes-256-cbc -e -a -salt -pass pass:<password> -in plaintext
 
+        If a kdf was specified without openssl, the result is in the
+        binary format instead of base64.
+
+        If a content hash was specified, its digest is available in
+        m_content_digest afterwards. In the binary format it is also
+        encrypted with the plaintext.
+
         @param password  The password.
         @param plaintext The plaintext to encrypt.
         @param msgdgst   The message digest algorithm. (Not implemented)
         '''
         # Setup key and IV for both modes.
-        if self.m_openssl:
-            salt = os.urandom(self.m_ivlen - len(self.m_openssl_prefix))
-            key, iv = self._get_key_and_iv(password, salt)
-            if key is None or iv is None:
-                return None
-        else:
-            # No 'Salted__' prefix.
-            key = self._get_password_key(password)
-            iv = os.urandom(self.m_ivlen)  # IV is the same as block size for CBC mode
-
-        # Key
-        key = self._encode(key)
-
-        # Encrypt
-        padded_plaintext = self._pkcs7_pad(plaintext, self.m_ivlen)
-        backend = default_backend()
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
-        encryptor = cipher.encryptor()
-        ciphertext_binary = encryptor.update(padded_plaintext) + encryptor.finalize()
-
-        # Finalize
-        if self.m_openssl:
-            # Make openssl compatible.
+        header, key, iv = self._new_header(password)
+        if key is None or iv is None:
+            return None
+        suffix = b''
+        if self.m_hash:
+            self.m_content_digest = hashlib.new(self.m_hash, plaintext).digest()
+            if self.m_binary:
+                suffix = self.m_content_digest
+
+        # Encrypt directly into a pooled buffer that is big enough for
+        # the header, the ciphertext and the slack that update_into()
+        # requires. Only the last block is copied to add the padding.
+        size = len(plaintext)
+        full = size - (size % self.m_ivlen)
+        buf = th_buffers.acquire(len(header) + full + len(suffix) + 2 * self.m_ivlen)
+        view = memoryview(buf)
+        try:
+            view[:len(header)] = header
+            backend = default_backend()
+            cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
+            encryptor = cipher.encryptor()
+            plaintext = memoryview(plaintext)
+            num = len(header) + encryptor.update_into(plaintext[:full], view[len(header):])
+            last = self._pkcs7_pad(plaintext[full:].tobytes() + suffix, self.m_ivlen)
+            num += encryptor.update_into(last, view[num:])
+            encryptor.finalize()
+
+            # Finalize
+            # For openssl the header is the 'Salted__' prefix and the salt.
             # I first discovered this when I wrote the C++ Cipher class.
             # CITATION: http://projects.joelinoff.com/cipher-1.1/doxydocs/html/
-            openssl_compatible = self.m_openssl_prefix + salt + ciphertext_binary
-            ciphertext = base64.b64encode(openssl_compatible)
-        else:
-            ciphertext = base64.b64encode(iv + ciphertext_binary)
-
+            if self.m_binary:
+                ciphertext = view[:num].tobytes()
+            else:
+                ciphertext = base64.b64encode(view[:num])
+        finally:
+            view.release()
+            th_buffers.release(buf)
         return ciphertext
 
     def decrypt(self, password, ciphertext):
@@ -208,37 +449,206 @@ class AESCipher:
 
             $ egrep -v '^#|^$' | openssl enc -aes-256-cbc -d -a -salt -pass pass:<password> -in ciphertext
 
+        The binary format is detected automatically. If it has a
+        content hash, it is checked. Otherwise the content hash is
+        computed if one was specified. Either way its digest is
+        available in m_content_digest afterwards.
+
         @param password   The password.
         @param ciphertext The ciphertext to decrypt.
-        @returns the decrypted data.
+        @returns the decrypted data as a bytearray.
+        @raises ValueError if the header is bad, the password is wrong
+                or the content hash does not match.
+        '''
+        stored = None
+        if self.is_binary(ciphertext):
+            ciphertext_prefixed_binary = memoryview(ciphertext)
+            header_len = self.m_binary_header_len
+            header = ciphertext_prefixed_binary[:header_len].tobytes()
+            key, iv = self._parse_binary_header(password, header)
+            stored = self.get_binary_hash(header)
+        else:
+            ciphertext_prefixed_binary = memoryview(base64.b64decode(ciphertext))
+            header_len = self.m_ivlen
+            header = ciphertext_prefixed_binary[:header_len].tobytes()
+            key, iv = self._parse_header(password, header)
+        if key is None or iv is None:
+            return None
+
+        # Decrypt directly into the buffer that is returned so that the
+        # ciphertext is never copied.
+        ciphertext_binary = ciphertext_prefixed_binary[header_len:]
+        plaintext = bytearray(len(ciphertext_binary) + self.m_ivlen)
+        backend = default_backend()
+        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
+        decryptor = cipher.decryptor()
+        num = decryptor.update_into(ciphertext_binary, plaintext)
+        decryptor.finalize()
+        del plaintext[num:]
+        self._pkcs7_unpad(plaintext)
+        if stored is not None:
+            size = hashlib.new(stored).digest_size
+            if len(plaintext) < size:
+                raise ValueError('truncated content hash')
+            expected = bytes(plaintext[-size:])
+            del plaintext[-size:]
+            self.m_content_digest = hashlib.new(stored, plaintext).digest()
+            if not hmac.compare_digest(self.m_content_digest, expected):
+                raise ValueError('content hash mismatch, the file is corrupted')
+        elif self.m_hash:
+            self.m_content_digest = hashlib.new(self.m_hash, plaintext).digest()
+        return plaintext
+
+    def _new_header(self, password):
+        '''
+        Create the header that prefixes the ciphertext along with the
+        key and the IV used to encrypt it.
+
+        For openssl the header is the 'Salted__' prefix followed by
+        the salt, for the binary format it is described in __init__(),
+        otherwise it is the random IV.
+
+        @param password  The password.
+        @returns the header, the key and the IV.
+        '''
+        if self.m_binary:
+            run_salt = th_master_keys.run_salt(self.m_kdf, self.m_cost)
+            file_salt = os.urandom(16)
+            master, check = th_master_keys.get(self._encode(password), self.m_kdf, self.m_cost,
+                                               8, 1, run_salt)
+            key, iv = self._get_file_key_and_iv(master, file_salt)
+            content_hash = self.m_hashes.index(self.m_hash) + 1 if self.m_hash else 0
+            header = struct.pack(self.m_binary_format, self.m_binary_magic, 1,
+                                 self.m_kdfs.index(self.m_kdf) + 1, self.m_cost, 8, 1, content_hash,
+                                 run_salt, file_salt, check)
+        elif self.m_openssl:
+            salt = os.urandom(self.m_ivlen - len(self.m_openssl_prefix))
+            if self.m_kdf is not None:
+                key, iv = self._get_pbkdf2_key_and_iv(password, salt)
+            else:
+                key, iv = self._get_key_and_iv(password, salt)
+            header = self.m_openssl_prefix + salt
+        else:
+            # No 'Salted__' prefix.
+            key = self._get_password_key(password)
+            iv = os.urandom(self.m_ivlen)  # IV is the same as block size for CBC mode
+            header = iv
+        return header, self._encode(key), iv
+
+    def _parse_header(self, password, header):
+        '''
+        Get the key and the IV from the header that prefixes the
+        ciphertext.
+
+        @param password  The password.
+        @param header    The first ivlen bytes of the binary ciphertext.
+        @returns the key and the IV.
         '''
+        if len(header) < self.m_ivlen:
+            raise ValueError('truncated header')
         if self.m_openssl:
-            # Base64 decode
-            ciphertext_prefixed_binary = base64.b64decode(ciphertext)
-            if ciphertext_prefixed_binary[:self.m_openssl_prefix_len] != self.m_openssl_prefix:
-                err('bad header, cannot decrypt')
-            salt = ciphertext_prefixed_binary[self.m_openssl_prefix_len:self.m_ivlen]  # get the salt
+            if header[:self.m_openssl_prefix_len] != self.m_openssl_prefix:
+                raise ValueError('bad header')
+            salt = header[self.m_openssl_prefix_len:self.m_ivlen]  # get the salt
 
             # Now create the key and iv.
-            key, iv = self._get_key_and_iv(password, salt)
-            if key is None or iv is None:
-                return None
+            if self.m_kdf is not None:
+                key, iv = self._get_pbkdf2_key_and_iv(password, salt)
+            else:
+                key, iv = self._get_key_and_iv(password, salt)
         else:
             key = self._get_password_key(password)
-            ciphertext_prefixed_binary = base64.b64decode(ciphertext)
-            iv = ciphertext_prefixed_binary[:self.m_ivlen]  # IV is the same as block size for CBC mode
+            iv = header[:self.m_ivlen]  # IV is the same as block size for CBC mode
+        return self._encode(key), iv
 
-        # Key
-        key = self._encode(key)
+    def _parse_binary_header(self, password, header):
+        '''
+        Get the key and the IV from the header of the binary format.
 
-        # Decrypt
-        ciphertext_binary = ciphertext_prefixed_binary[self.m_ivlen:]
-        backend = default_backend()
-        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=backend)
-        decryptor = cipher.decryptor()
-        padded_plaintext  = decryptor.update(ciphertext_binary) + decryptor.finalize()
-        plaintext = self._pkcs7_unpad(padded_plaintext)
-        return plaintext
+        The master key is derived using the KDF parameters stored in
+        the header so the kdf and cost of this object do not matter.
+
+        @param password  The password.
+        @param header    The binary header.
+        @returns the key and the IV.
+        '''
+        if len(header) < self.m_binary_header_len:
+            raise ValueError('truncated header')
+        fields = struct.unpack(self.m_binary_format, header)
+        magic, version, kdf, cost, r, p, reserved, run_salt, file_salt, check = fields
+        if magic != self.m_binary_magic or version != 1 or kdf < 1 or kdf > len(self.m_kdfs):
+            raise ValueError('bad header')
+        kdf = self.m_kdfs[kdf - 1]
+        if not is_kdf_cost_valid(kdf, cost, r, p):
+            raise ValueError('bad header, the kdf cost is out of range')
+        master, expected = th_master_keys.get(self._encode(password), kdf, cost, r, p, run_salt)
+        if not hmac.compare_digest(check, expected):
+            raise ValueError('wrong password')
+        return self._get_file_key_and_iv(master, file_salt)
+
+    def is_binary(self, data):
+        '''
+        Is the data in the binary format?
+
+        The first byte of the binary format is never valid base64 so
+        the first byte is enough to tell.
+
+        @param data  The start of the locked data.
+        '''
+        return bytes(data[:1]) == self.m_binary_magic[:1]
+
+    def get_binary_kdf(self, header):
+        '''
+        Get the KDF that a file in the binary format was locked with.
+
+        @param header  The start of the locked data.
+        @returns the kdf name and the cost.
+        @raises ValueError if the header is not valid.
+        '''
+        if len(header) < self.m_binary_header_len:
+            raise ValueError('truncated header')
+        fields = struct.unpack(self.m_binary_format, bytes(header[:self.m_binary_header_len]))
+        magic, version, kdf, cost = fields[:4]
+        if magic != self.m_binary_magic or version != 1 or kdf < 1 or kdf > len(self.m_kdfs):
+            raise ValueError('bad header')
+        return self.m_kdfs[kdf - 1], cost
+
+    def get_binary_hash(self, header):
+        '''
+        Get the content hash of a file in the binary format.
+
+        @param header  The binary header.
+        @returns the hash name or None if there is no content hash.
+        @raises ValueError if the hash is not supported.
+        '''
+        content_hash = bytearray(header[12:13])[0]
+        if content_hash == 0:
+            return None
+        if content_hash > len(self.m_hashes):
+            raise ValueError('bad header, unsupported content hash')
+        return self.m_hashes[content_hash - 1]
+
+    def _get_file_key_and_iv(self, master, file_salt):
+        '''
+        Derive the key and the IV for a file from the master key.
+
+        @param master     The master key.
+        @param file_salt  The random salt of the file.
+        '''
+        keyiv = HKDF(algorithm=hashes.SHA256(), length=self.m_keylen + self.m_ivlen, salt=file_salt,
+                     info=b'lock_files file key', backend=default_backend()).derive(master)
+        return keyiv[:self.m_keylen], keyiv[self.m_keylen:]
+
+    def _get_pbkdf2_key_and_iv(self, password, salt):
+        '''
+        Derive the key and the IV like openssl -pbkdf2 -iter <cost>.
+
+        @param password  The password.
+        @param salt      The salt.
+        '''
+        keyiv = PBKDF2HMAC(algorithm=hashes.SHA256(), length=self.m_keylen + self.m_ivlen, salt=salt,
+                           iterations=self.m_cost, backend=default_backend()).derive(self._encode(password))
+        return keyiv[:self.m_keylen], keyiv[self.m_keylen:]
 
     def _get_password_key(self, password):
         '''
@@ -268,7 +678,8 @@ class AESCipher:
         try:
             # Ignore is okay here because it will be symmetric for
             # both encrypt and decrypt operations.
-            password = password.encode('utf-8', 'ignore')
+            if isinstance(password, str):
+                password = password.encode('utf-8', 'ignore')
             maxlen = self.m_keylen + self.m_ivlen
             keyiv = self.m_digest(password + salt).digest()
             digest = keyiv
@@ -284,13 +695,10 @@ class AESCipher:
 
     def _encode(self, val):
         '''
-        Encode a string for Python 2/3 compatibility.
+        Encode a string as UTF-8 bytes.
         '''
         if isinstance(val, str):
-            try:
-                val = val.encode('utf-8')
-            except UnicodeDecodeError:
-                pass  # python 2, don't care
+            val = val.encode('utf-8')
         return val
 
     def _pkcs7_pad(self, text, size):
@@ -306,7 +714,6 @@ class AESCipher:
         '''
         num_bytes = size - (len(text) % size)
 
-        # Works for python3 and python2.
         if isinstance(text, str):
             text += chr(num_bytes) * num_bytes
         elif isinstance(text, bytes):
@@ -315,336 +722,2338 @@ class AESCipher:
             assert False
         return text
 
-    def _pkcs7_unpad(self, padded):
+    def _pkcs7_unpad(self, padded, size=None):
         '''
         PKCS#7 unpadding.
 
         We padded with the number of characters to unpad.
-        Just get it and truncate the string.
-        Works for python 2/3.
+        Check that every padding character has that value, then
+        truncate the string. A bytearray is truncated in place so
+        that it is not copied.
+
+        @param padded  The padded text.
+        @param size    The size of the block, the AES block size by
+                       default.
+        @raises ValueError if the padding is invalid, which usually
+                means that the password is wrong.
         '''
-        if isinstance(padded, str):
-            unpadded_len = ord(padded[-1])
-        elif isinstance(padded, bytes):
-            unpadded_len = padded[-1]
-        else:
-            assert False
-        return padded[:-unpadded_len]
+        size = size or self.m_ivlen
+        last = padded[-1:]
+        num = ord(last) if len(last) > 0 else 0
+        if num < 1 or num > size or num > len(padded) or padded[-num:] != last * num:
+            raise ValueError('bad padding, the password may be wrong')
+        if isinstance(padded, bytearray):
+            del padded[-num:]
+            return padded
+        return padded[:-num]
+
+
+class AESStreamEncryptor:
+    '''
+    Incremental encryptor for data that does not fit in memory.
 
+    The output is identical to AESCipher.encrypt() for the same
+    header but it is generated chunk by chunk so the memory used is
+    bounded by the chunk size rather than by the size of the input.
 
-# ================================================================
-#
-# Message Utility Functions.
-#
-# ================================================================
-def _msg(prefix, msg, level, ofp):
-    '''
-    Thread safe message reporting.
+    The ciphertext is generated with update_into() in a buffer from
+    the pool so the only allocation per chunk is the base64 output.
+    In the binary format there is no allocation at all, the memoryview
+    that is returned is only valid until the next call.
+
+    If the cipher has a content hash, the plaintext is hashed as it
+    is encrypted and the digest is available in m_digest after
+    finalize().
     '''
-    th_mutex.acquire()
-    try:
-        ofp.write('{}:{} {}\n'.format(prefix, inspect.stack()[level][2], msg))
-    finally:
-        th_mutex.release()
+    def __init__(self, cipher, password):
+        '''
+        Initialize the object.
 
+        @param cipher    The AESCipher object that defines the format.
+        @param password  The password.
+        '''
+        header, key, iv = cipher._new_header(password)
+        if key is None or iv is None:
+            raise ValueError('failed to generate key and iv')
+        self.m_blocklen = cipher.m_ivlen
+        self.m_binary = cipher.m_binary
+        self.m_encryptor = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend()).encryptor()
+        self.m_size = 0  # number of plaintext bytes
+        self.m_buf = th_buffers.acquire(CHUNK_SIZE + len(header) + 2 * self.m_blocklen)
+        self.m_buf[:len(header)] = header
+        self.m_pending = len(header)  # bytes at the start of the buffer that are not base64 encoded yet
+        self.m_hasher = hashlib.new(cipher.m_hash) if cipher.m_hash else None
+        self.m_embed = cipher.m_binary and self.m_hasher is not None  # store the digest in the file
+        self.m_digest = None
+
+    def update(self, plaintext):
+        '''
+        Encrypt the next chunk of plaintext.
 
-def info(msg, level=1, ofp=sys.stdout):
-    '''
-    Display a simple information message with context information.
-    '''
-    _msg('INFO', msg, level+1, ofp)
+        @param plaintext  The plaintext chunk.
+        @returns the ciphertext that is available so far.
+        '''
+        self.m_size += len(plaintext)
+        if self.m_hasher is not None:
+            self.m_hasher.update(plaintext)
+        return self._encode(plaintext, False)
 
+    def finalize(self, plaintext=b''):
+        '''
+        Encrypt the last chunk of plaintext, pad the last block and
+        flush the remaining ciphertext.
 
-def infov(opts, msg, level=1, ofp=sys.stdout):
-    '''
-    Display a simple information message with context information.
-    '''
-    if opts.verbose:
-        _msg('INFO', msg, level+1, ofp)
+        @param plaintext  The last plaintext chunk.
+        @returns the remaining ciphertext.
+        '''
+        if self.m_hasher is not None:
+            self.m_hasher.update(plaintext)
+            self.m_digest = self.m_hasher.digest()
+            if self.m_embed:
+                plaintext = bytes(plaintext) + self.m_digest
+        self.m_size += len(plaintext)
+        num_bytes = self.m_blocklen - (self.m_size % self.m_blocklen)
+        return self._encode(plaintext, True, bytearray([num_bytes]) * num_bytes)
+
+    def close(self):
+        '''
+        Return the buffer to the pool.
+        '''
+        if self.m_buf is not None:
+            th_buffers.release(self.m_buf)
+            self.m_buf = None
 
+    def _encode(self, plaintext, final, padding=b''):
+        '''
+        Encrypt into the buffer and base64 encode as much of it as
+        possible.
 
-def infov2(opts, msg, level=1, ofp=sys.stdout):
-    '''
-    Display a simple information message with context information.
-    '''
-    if opts.verbose > 1:
-        _msg('INFO', msg, level+1, ofp)
+        Only multiples of 3 bytes are encoded until the final call so
+        that no intermediate base64 padding is generated. The 0-2
+        bytes that are left are moved to the start of the buffer.
+
+        In the binary format, a view of the buffer is returned.
+        '''
+        need = self.m_pending + len(plaintext) + len(padding) + 2 * self.m_blocklen
+        if len(self.m_buf) < need:
+            buf = th_buffers.acquire(need)
+            buf[:self.m_pending] = self.m_buf[:self.m_pending]
+            th_buffers.release(self.m_buf)
+            self.m_buf = buf
+        view = memoryview(self.m_buf)
+        try:
+            total = self.m_pending + self.m_encryptor.update_into(plaintext, view[self.m_pending:])
+            if final is True:
+                total += self.m_encryptor.update_into(padding, view[total:])
+                self.m_encryptor.finalize()
+            if self.m_binary:
+                self.m_pending = 0
+                return view[:total]
+            num = total if final is True else total - (total % 3)
+            ciphertext = base64.b64encode(view[:num])
+            self.m_pending = total - num
+            view[:self.m_pending] = view[num:total]
+        finally:
+            view.release()
+        return ciphertext
 
 
-def err(msg, level=1, ofp=sys.stdout):
+class AESStreamDecryptor:
     '''
-    Display error message with context information and exit.
+    Incremental decryptor for data that does not fit in memory.
+
+    It accepts the output of AESCipher.encrypt() or AESStreamEncryptor
+    in arbitrary chunks, including line breaks if it is base64
+    encoded, and returns the plaintext. The binary format is detected
+    from the first byte. The last plaintext block is held back until
+    finalize() so that the padding can be removed, along with the
+    content hash if the binary header has one. The content hash is
+    checked by finalize().
+
+    The plaintext is generated with update_into() in a buffer from
+    the pool. The memoryview that is returned is only valid until the
+    next call.
     '''
-    _msg('ERROR', msg, level+1, ofp)
-    abort_threads()
-    sys.exit(1)
+    def __init__(self, cipher, password):
+        '''
+        Initialize the object.
+
+        @param cipher    The AESCipher object that defines the format.
+        @param password  The password.
+        '''
+        self.m_cipher = cipher
+        self.m_password = password
+        self.m_blocklen = cipher.m_ivlen
+        self.m_decryptor = None  # created when the header is available
+        self.m_binary = None  # the format, detected from the first byte
+        self.m_header = b''
+        self.m_text = b''  # base64 text that has not been decoded yet
+        self.m_buf = th_buffers.acquire(CHUNK_SIZE + 2 * self.m_blocklen)
+        self.m_tail = 0  # offset of the last plaintext block in the buffer
+        self.m_tail_len = 0  # length of the last plaintext block
+        self.m_hasher = None  # created when the header is available
+        self.m_stored_len = 0  # length of the content hash stored in the file
+        self.m_digest = None  # the content hash, available after finalize()
+
+    def update(self, ciphertext):
+        '''
+        Decrypt the next chunk of base64 encoded ciphertext.
+
+        @param ciphertext  The ciphertext chunk.
+        @returns the plaintext that is available so far.
+        '''
+        if self.m_binary is None and len(ciphertext) > 0:
+            self.m_binary = self.m_cipher.is_binary(ciphertext)
+        if self.m_binary is True:
+            plaintext = self._decrypt(ciphertext)
+        else:
+            text = bytes(ciphertext).translate(None, b' \t\r\n\v\f')
+            if self.m_text:
+                text = self.m_text + text
+            num = len(text) - (len(text) % 4)
+            self.m_text = text[num:]
+            plaintext = self._decrypt(binascii.a2b_base64(memoryview(text)[:num]))
+        if self.m_hasher is not None:
+            self.m_hasher.update(plaintext)
+        return plaintext
 
+    def finalize(self, ciphertext=b''):
+        '''
+        Decrypt the last chunk, the last block and remove the padding.
 
-def errn(msg, level=1, ofp=sys.stdout):
+        @param ciphertext  The last ciphertext chunk.
+        @returns the remaining plaintext.
+        @raises ValueError if the data is truncated or the padding is invalid.
+        '''
+        if self.m_binary is None and len(ciphertext) > 0:
+            self.m_binary = self.m_cipher.is_binary(ciphertext)
+        if self.m_binary is True:
+            self._decrypt(ciphertext)
+        else:
+            text = self.m_text + ciphertext if self.m_text else ciphertext
+            self.m_text = b''
+            self._decrypt(binascii.a2b_base64(text))
+        if self.m_decryptor is None:
+            raise ValueError('truncated header')
+        self.m_decryptor.finalize()
+        if self.m_tail_len != self.m_blocklen + self.m_stored_len:
+            raise ValueError('truncated ciphertext')
+        total = self.m_tail + self.m_tail_len
+        num_bytes = self.m_buf[total - 1]
+        if num_bytes < 1 or num_bytes > self.m_blocklen or \
+           self.m_buf[total - num_bytes:total] != self.m_buf[total - 1:total] * num_bytes:
+            raise ValueError('bad padding, the password may be wrong')
+        self.m_tail_len = 0
+        end = total - num_bytes - self.m_stored_len
+        plaintext = memoryview(self.m_buf)[:end]
+        if self.m_hasher is not None:
+            self.m_hasher.update(plaintext)  # including the last chunk that _decrypt() returned above
+            self.m_digest = self.m_hasher.digest()
+            if self.m_stored_len > 0 and \
+               not hmac.compare_digest(self.m_digest, bytes(self.m_buf[end:end + self.m_stored_len])):
+                raise ValueError('content hash mismatch, the file is corrupted')
+        return plaintext
+
+    def close(self):
+        '''
+        Return the buffer to the pool.
+        '''
+        if self.m_buf is not None:
+            th_buffers.release(self.m_buf)
+            self.m_buf = None
+
+    def _decrypt(self, binary):
+        '''
+        Decrypt binary ciphertext into the buffer.
+
+        The last block of the previous call is moved to the start of
+        the buffer and the new plaintext is appended to it. The last
+        block is held back again.
+        '''
+        binary = memoryview(binary)
+        if self.m_decryptor is None:
+            size = self.m_cipher.m_binary_header_len if self.m_binary else self.m_blocklen
+            need = size - len(self.m_header)
+            self.m_header += binary[:need].tobytes()
+            if len(self.m_header) < size:
+                return memoryview(b'')
+            binary = binary[need:]
+            content_hash = self.m_cipher.m_hash
+            if self.m_binary:
+                key, iv = self.m_cipher._parse_binary_header(self.m_password, self.m_header)
+                stored = self.m_cipher.get_binary_hash(self.m_header)
+                if stored is not None:
+                    content_hash = stored
+                    self.m_stored_len = hashlib.new(stored).digest_size
+            else:
+                key, iv = self.m_cipher._parse_header(self.m_password, self.m_header)
+            if key is None or iv is None:
+                raise ValueError('failed to generate key and iv')
+            if content_hash:
+                self.m_hasher = hashlib.new(content_hash)
+            cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+            self.m_decryptor = cipher.decryptor()
+        need = self.m_tail_len + len(binary) + self.m_blocklen
+        if len(self.m_buf) < need:
+            buf = th_buffers.acquire(need)
+            buf[:self.m_tail_len] = self.m_buf[self.m_tail:self.m_tail + self.m_tail_len]
+            th_buffers.release(self.m_buf)
+            self.m_buf = buf
+        elif self.m_tail > 0:
+            self.m_buf[:self.m_tail_len] = self.m_buf[self.m_tail:self.m_tail + self.m_tail_len]
+        view = memoryview(self.m_buf)
+        total = self.m_tail_len + self.m_decryptor.update_into(binary, view[self.m_tail_len:])
+        num = max(total - self.m_blocklen - self.m_stored_len, 0)
+        self.m_tail = num
+        self.m_tail_len = total - num
+        return view[:num]
+
+
+class LineWriter:
     '''
-    Display error message with context information but do not exit.
+    Write data to a binary file object, optionally breaking it into
+    lines of a fixed width.
+
+    The output is identical to the output of write_file() for the
+    same content even though the content arrives in chunks.
     '''
-    _msg('ERROR', msg, level+1, ofp)
+    def __init__(self, ofp, width=0):
+        '''
+        Initialize the object.
 
+        @param ofp    The binary file object.
+        @param width  The line width, zero means no new lines.
+        '''
+        self.m_ofp = ofp
+        self.m_width = width
+        self.m_col = 0  # current column
+        self.m_size = 0  # bytes written, not counting new lines
 
-def warn(msg, level=1, ofp=sys.stdout):
+    def write(self, data):
+        '''
+        Write the data, inserting new lines as needed.
+        '''
+        self.m_size += len(data)
+        if self.m_width < 1:
+            self.m_ofp.write(data)
+            return
+        data = memoryview(data)
+        i = 0
+        while i < len(data):
+            num = min(self.m_width - self.m_col, len(data) - i)
+            self.m_ofp.write(data[i:i+num])
+            self.m_col += num
+            i += num
+            if self.m_col == self.m_width:
+                self.m_ofp.write(b'\n')
+                self.m_col = 0
+
+    def close(self):
+        '''
+        Terminate the last line and flush the output.
+        '''
+        if self.m_col > 0:
+            self.m_ofp.write(b'\n')
+            self.m_col = 0
+        self.m_ofp.flush()
+
+
+class NullFile:
     '''
-    Display error message with context information but do not exit.
+    Binary file object that discards everything written to it.
+    It is the sink for --verify.
     '''
-    _msg('WARNING', msg, level+1, ofp)
+    def write(self, data):
+        '''
+        Discard the data.
+        '''
+        return len(data)
 
+    def flush(self):
+        '''
+        Nothing to flush.
+        '''
+        pass
 
-def _println(msg, ofp=sys.stdout):
+
+class HashWriter:
     '''
-    Print a message with a new line.
+    Binary file object that computes the SHA-256 of the data that is
+    written to it before it passes it on. It checks the content of the
+    --dedup store when it is unlocked or verified.
     '''
-    th_mutex.acquire()
-    try:
-        ofp.write(msg + '\n')
-    finally:
-        th_mutex.release()
+    def __init__(self, ofp):
+        '''
+        Initialize the object.
 
+        @param ofp  The binary file object.
+        '''
+        self.m_ofp = ofp
+        self.m_hasher = hashlib.sha256()
 
-# ================================================================
-#
-# Thread utility functions.
-#
-# ================================================================
-def abort_threads():
+    def write(self, data):
+        '''
+        Hash and write the data.
+        '''
+        self.m_hasher.update(data)
+        return self.m_ofp.write(data)
+
+    def flush(self):
+        '''
+        Flush the output.
+        '''
+        self.m_ofp.flush()
+
+
+class Journal:
     '''
-    Set the abort flag.
+    Append-only journal of completed files and in-flight temporary
+    outputs that allows an interrupted run to be resumed.
+
+    Each record is a JSON object on a single line:
+
+       {"op": "begin", "src": SRC, "tmp": TMP, "out": OUT, "old": OLD}
+       {"op": "renamed", "src": SRC}
+       {"op": "done", "src": SRC, "out": OUT}
+
+    The output is written to TMP and renamed to OUT when it is
+    complete. The directory and then the "renamed" record are synced
+    to disk before the input is removed so a replay can always tell
+    whether OUT is complete.
+    If the run stopped between the rename and the "renamed" record,
+    TMP is gone and OUT is no longer the file OLD (the device and
+    inode of OUT at the start, null if it did not exist).
+    Concurrent syncs are grouped so that a single fsync covers all of
+    the records written before it.
     '''
-    th_mutex.acquire()
-    try:
-        global th_abort
-        th_abort = True
-    finally:
-        th_mutex.release()
+    def __init__(self, path, resume=False):
+        '''
+        Initialize the object.
+
+        @param path    The journal file.
+        @param resume  Replay the existing journal before appending.
+        '''
+        self.m_path = os.path.abspath(path)
+        self.m_mutex = Lock()  # serializes appends
+        self.m_sync_mutex = Lock()  # serializes fsyncs
+        self.m_seq = 0  # number of records written
+        self.m_synced = 0  # number of records known to be on disk
+        self.m_resume = resume
+        self.m_done = set()  # keys of outputs completed by the previous runs, if resuming
+        self.m_cleaned = 0  # number of partial outputs removed by the replay
+        self.m_torn = False  # the last record of the journal is incomplete
+        inflight = self._replay() if resume is True else {}
+        self.m_ofp = open(path, 'a')
+        if self.m_torn is True:
+            # Terminate the torn record so that it does not swallow
+            # the next one.
+            self.m_ofp.write('\n')
+        for src, rec in inflight.items():
+            if rec.get('renamed') is True or self._is_replaced(rec):
+                # The output is complete, only the input removal
+                # may be missing.
+                if rec['out'] != src and os.path.exists(src):
+                    os.remove(src)
+                self.done(src, rec['out'])
+            elif os.path.exists(rec['tmp']):
+                os.remove(rec['tmp'])
+                self.m_cleaned += 1
+
+    def begin(self, src, out):
+        '''
+        Record the start of an operation.
+
+        @param src  The input file.
+        @param out  The final output file.
+        @returns the temporary file to write the output to.
+        '''
+        src = os.path.abspath(src)
+        out = os.path.abspath(out)
+        tmp = get_tmp_path(out)
+        try:
+            st = os.stat(out)
+            old = [st.st_dev, st.st_ino]
+        except OSError:
+            old = None
+        self._write({'op': 'begin', 'src': src, 'tmp': tmp, 'out': out, 'old': old})
+        return tmp
+
+    def renamed(self, src):
+        '''
+        Record that the temporary output was renamed to the final
+        output. It is on disk when this returns.
+        '''
+        self._write({'op': 'renamed', 'src': os.path.abspath(src)}, sync=True)
+
+    def done(self, src, out):
+        '''
+        Record that the operation is complete.
+        '''
+        out = os.path.abspath(out)
+        self._write({'op': 'done', 'src': os.path.abspath(src), 'out': out})
+        if self.m_resume is True:
+            # A fresh run never sees its own outputs, the directories
+            # are listed before they are written.
+            self.m_done.add(self._key(out))
+
+    def is_done(self, path):
+        '''
+        Is this file the output of an operation that was completed by
+        a previous run?
+        '''
+        return self._key(path) in self.m_done
+
+    def is_journal(self, path):
+        '''
+        Is this file the journal itself?
+        '''
+        return os.path.abspath(path) == self.m_path
+
+    def close(self):
+        '''
+        Sync and close the journal.
+        '''
+        self.m_ofp.flush()
+        os.fsync(self.m_ofp.fileno())
+        self.m_ofp.close()
+
+    def _key(self, path):
+        '''
+        Compact key for a path so that millions of completed files
+        can be tracked in memory.
+        '''
+        return hashlib.md5(os.fsencode(os.path.abspath(path))).digest()
+
+    def _replay(self):
+        '''
+        Read the existing journal.
+
+        @returns the begin records of the operations that did not complete.
+        '''
+        inflight = {}
+        with open(self.m_path, 'r') as ifp:
+            for line in ifp:
+                self.m_torn = not line.endswith('\n')
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # torn write from a crash
+                if rec['op'] == 'begin':
+                    inflight[rec['src']] = rec
+                elif rec['op'] == 'renamed' and rec['src'] in inflight:
+                    inflight[rec['src']]['renamed'] = True
+                elif rec['op'] == 'done':
+                    inflight.pop(rec['src'], None)
+                    self.m_done.add(self._key(rec['out']))
+        return inflight
+
+    def _is_replaced(self, rec):
+        '''
+        Was the temporary output of an operation renamed to the final
+        output without a "renamed" record?
+        '''
+        if os.path.exists(rec['tmp']):
+            return False
+        try:
+            st = os.stat(rec['out'])
+        except OSError:
+            return False
+        return [st.st_dev, st.st_ino] != rec.get('old')
+
+    def _write(self, rec, sync=False):
+        '''
+        Append a record, optionally waiting until it is on disk.
+        '''
+        line = json.dumps(rec) + '\n'
+        with self.m_mutex:
+            self.m_ofp.write(line)
+            self.m_ofp.flush()
+            self.m_seq += 1
+            seq = self.m_seq
+        if sync is True:
+            with self.m_sync_mutex:
+                if self.m_synced < seq:
+                    with self.m_mutex:
+                        seq = self.m_seq
+                    os.fsync(self.m_ofp.fileno())
+                    self.m_synced = seq
+
+
+class Manifest:
+    '''
+    Sidecar manifest of the content hashes of the plaintext files in
+    the format of sha256sum and b2sum so that the unlocked files can
+    also be checked with "sha256sum -c" or "b2sum -c".
+
+    When files are locked, a line is appended for each file with a
+    single write to a file opened in append mode so the worker
+    threads do not need a lock. Otherwise the manifest is read and the
+    hashes are checked.
+
+    The paths are relative to the directory of the manifest. Like
+    sha256sum, a path with a backslash or a newline is escaped and
+    its line starts with a backslash.
+    '''
+    def __init__(self, path, append):
+        '''
+        Initialize the object.
+
+        @param path    The manifest file.
+        @param append  Append to the manifest instead of reading it.
+        '''
+        self.m_path = path
+        self.m_root = os.path.dirname(os.path.abspath(path))
+        self.m_fd = None
+        self.m_digests = {}  # path relative to the root -> hex digest
+        self.m_hash = None  # the hash of the entries, from the digest length
+        if append:
+            self.m_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            return
+        sizes = {64: 'sha256', 128: 'blake2b'}
+        with open(path, 'rb') as ifp:
+            for line in ifp:
+                line = line.rstrip(b'\r\n').decode('utf-8', 'surrogateescape')
+                escaped = line.startswith('\\')
+                fields = (line[1:] if escaped else line).split(' ', 1)
+                if len(fields) != 2 or len(fields[1]) < 2 or fields[0].startswith('#'):
+                    continue
+                name = fields[1][1:]
+                if escaped:
+                    name = self._unescape(name)
+                    if name is None:
+                        continue
+                self.m_hash = sizes.get(len(fields[0]), self.m_hash)
+                self.m_digests[self._key(os.path.join(self.m_root, name))] = fields[0].lower()
+
+    def update(self, path, digest):
+        '''
+        Add the content hash of a file when locking or check it when
+        unlocking or verifying.
+
+        @param path    The plaintext file.
+        @param digest  The content hash.
+        @raises ValueError if the hash does not match.
+        '''
+        hexdigest = binascii.hexlify(digest).decode('ascii')
+        key = self._key(path)
+        if self.m_fd is not None:
+            if '\\' in key or '\n' in key:
+                name = key.replace('\\', '\\\\').replace('\n', '\\n')
+                line = '\\{}  {}\n'.format(hexdigest, name)
+            else:
+                line = '{}  {}\n'.format(hexdigest, key)
+            os.write(self.m_fd, line.encode('utf-8', 'surrogateescape'))
+            return
+        expected = self.m_digests.get(key)
+        if expected is None:
+            raise ValueError('"{}" is not in the manifest'.format(path))
+        if not hmac.compare_digest(expected, hexdigest):
+            raise ValueError('content hash mismatch with the manifest, the file is corrupted')
+
+    def close(self):
+        '''
+        Sync and close the manifest.
+        '''
+        if self.m_fd is not None:
+            os.fsync(self.m_fd)
+            os.close(self.m_fd)
+            self.m_fd = None
+
+    def _key(self, path):
+        '''
+        Get the normalized path of a file relative to the directory
+        of the manifest, so that "a" and "./a" are the same file.
+        '''
+        path = os.path.abspath(path)
+        try:
+            return os.path.relpath(path, self.m_root)
+        except ValueError:
+            return path  # on another drive
+
+    def _unescape(self, name):
+        '''
+        Unescape a path of an escaped line.
+
+        @returns the path or None if it is not escaped correctly.
+        '''
+        parts = []
+        i = 0
+        while i < len(name):
+            if name[i] != '\\':
+                parts.append(name[i])
+            elif name[i+1:i+2] == '\\':
+                parts.append('\\')
+                i += 1
+            elif name[i+1:i+2] == 'n':
+                parts.append('\n')
+                i += 1
+            else:
+                return None
+            i += 1
+        return ''.join(parts)
+
+
+class DedupStore:
+    '''
+    Content addressed store for --dedup.
+
+    Each unique content is locked once into the store and the locked
+    file of each path is a small reference to it. The address of a
+    content is the HMAC-SHA256 of its SHA-256 with a key derived from
+    the password and the salt of the store so that the addresses do
+    not reveal the hashes of the files to anyone without the password.
+
+    The layout of the store is:
+
+       DIR/salt        the random salt, created by the first run
+       DIR/ab/abcd...  the locked content, in directories by the
+                       first two hex digits of the address
+    '''
+    def __init__(self, path, password, create):
+        '''
+        Initialize the object.
+
+        @param path      The store directory.
+        @param password  The password.
+        @param create    Create the store if it does not exist.
+        '''
+        self.m_path = path
+        self.m_magic = b'#lock_files dedup '  # never valid base64 or the binary magic
+        self.m_ref_len = len(self.m_magic) + 64 + 1
+        salt_path = os.path.join(path, 'salt')
+        if create is True and not os.path.exists(salt_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            # Publish the salt atomically in case several shards
+            # create the store at the same time.
+            tmp = get_tmp_path(salt_path) + '.{}'.format(os.getpid())
+            with open(tmp, 'wb') as ofp:
+                ofp.write(os.urandom(16))
+            try:
+                os.link(tmp, salt_path)
+            except OSError:
+                pass  # another shard was first
+            finally:
+                os.remove(tmp)
+        with open(salt_path, 'rb') as ifp:
+            salt = ifp.read()
+        if isinstance(password, str):
+            password = password.encode('utf-8', 'ignore')
+        master, _ = th_master_keys.get(password, 'pbkdf2', KDF_COSTS['pbkdf2'], 0, 0, salt)
+        self.m_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                          info=b'lock_files dedup', backend=default_backend()).derive(master)
+
+    def address(self, digest):
+        '''
+        Get the address of a content from its SHA-256.
+        '''
+        return hmac.new(self.m_key, digest, hashlib.sha256).hexdigest()
+
+    def object_path(self, address):
+        '''
+        Get the locked content of an address.
+        '''
+        return os.path.join(self.m_path, address[:2], address)
+
+    def reference(self, address):
+        '''
+        Get the content of the locked file that refers to an address.
+        '''
+        return self.m_magic + address.encode('ascii') + b'\n'
+
+    def read_reference(self, path, size=None):
+        '''
+        Read the address that a locked file refers to.
+        Only files of the size of a reference are read.
+
+        @param size  The size of the file if it is known.
+        @returns the address or None if it is not a reference.
+        '''
+        try:
+            if size is None:
+                size = os.path.getsize(path)
+            if size != self.m_ref_len:
+                return None
+            with open(path, 'rb') as ifp:
+                data = ifp.read(self.m_ref_len)
+        except (IOError, OSError):
+            return None  # let the caller report the problem
+        if not data.startswith(self.m_magic) or not data.endswith(b'\n'):
+            return None
+        return data[len(self.m_magic):-1].decode('ascii', 'replace')
+
+    def add(self, address, write):
+        '''
+        Store the locked content of an address unless it is already
+        stored, by a previous run or another worker.
+
+        @param write  Function that writes the locked content to the
+                      file it is passed and syncs it. It returns True
+                      if it succeeded.
+        @returns True if the content was stored, False if it was
+                 already stored or None if it failed.
+        '''
+        obj = self.object_path(address)
+        if os.path.exists(obj):
+            return False
+        if not os.path.isdir(os.path.dirname(obj)):
+            try:
+                os.mkdir(os.path.dirname(obj))
+            except OSError:
+                pass  # created by another worker
+        tmp = get_tmp_path(obj) + '.{}.{}'.format(os.getpid(), threading.current_thread().ident)
+        try:
+            if write(tmp) is not True:
+                return None
+            try:
+                os.link(tmp, obj)  # fails if another worker was first
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+                return False
+            return True
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def check(self, address, digest):
+        '''
+        Check that the SHA-256 of an unlocked content matches the
+        address that it was read from.
+        '''
+        return hmac.compare_digest(self.address(digest), address)
+
+
+class MemoryBudget:
+    '''
+    Shared byte budget for the data that the worker threads hold in
+    memory.
+
+    A worker reserves the estimated footprint of a file before it
+    reads it and releases it when it is done. If there is not enough
+    left, it waits until other workers release theirs.
+    '''
+    def __init__(self, size):
+        '''
+        Initialize the object.
+
+        @param size  The budget in bytes.
+        '''
+        self.m_size = size
+        self.m_used = 0
+        self.m_peak = 0
+        self.m_cond = threading.Condition(Lock())
+
+    def reserve(self, num):
+        '''
+        Reserve bytes, waiting until they are available.
+        A reservation that is larger than the budget is allowed when
+        nothing else is reserved so that it cannot wait forever.
+        '''
+        with self.m_cond:
+            while self.m_used > 0 and self.m_used + num > self.m_size:
+                self.m_cond.wait()
+            self.m_used += num
+            self.m_peak = max(self.m_peak, self.m_used)
+
+    def release(self, num):
+        '''
+        Release reserved bytes.
+        '''
+        with self.m_cond:
+            self.m_used -= num
+            self.m_cond.notify_all()
+
+
+class BatchStats(dict):
+    '''
+    The statistics of the batch of files that a worker is processing.
+
+    Only that worker updates them so stat_inc() does not need the
+    mutex for them. They are added to the statistics of the run once
+    at the end of the batch.
+    '''
+    def __missing__(self, key):
+        '''
+        Missing statistics are 0.
+        '''
+        return 0
+
+    def publish(self, stats):
+        '''
+        Add the statistics to the statistics of the run and reset
+        them.
+        '''
+        th_mutex.acquire()
+        try:
+            for key, value in self.items():
+                stats[key] += value
+        finally:  # avoid deadlock from exception
+            th_mutex.release()
+        self.clear()
+
+
+class Metrics:
+    '''
+    Per-file latency and throughput histograms and an optional
+    event log with one JSON line per file.
+
+    The histograms have fixed buckets and they are split by operation
+    and by file size class. Each thread records into its own
+    histograms so there is no lock per sample, they are merged when
+    the metrics are exported after the threads are done. Each thread
+    also buffers its events and appends them to the log with a single
+    write of whole lines to a file opened in append mode.
+    '''
+    m_latency_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                         1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]  # seconds
+    m_throughput_buckets = [1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9]  # bytes per second
+    m_size_classes = [(64 * 1024, '0-64K'), (1024 * 1024, '64K-1M'), (16 * 1024 * 1024, '1M-16M'),
+                      (256 * 1024 * 1024, '16M-256M'), (None, '256M+')]
+    m_event_buffer_size = 64 * 1024
+
+    def __init__(self, events=None):
+        '''
+        Initialize the object.
+
+        @param events  The event log file or None.
+        '''
+        self.m_local = threading.local()
+        self.m_threads = []  # the per-thread state of every thread that recorded
+        self.m_mutex = Lock()  # only taken once per thread
+        self.m_events_fd = None
+        if events:
+            self.m_events_fd = os.open(events, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def record(self, op, path, size, seconds, ok):
+        '''
+        Record the processing of a file.
+
+        @param op       The operation: lock, unlock, verify or rekey.
+        @param path     The file.
+        @param size     The size of the input file in bytes.
+        @param seconds  The time it took.
+        @param ok       True if it succeeded.
+        '''
+        local = self._get()
+        key = (op, self._get_size_class(size))
+        hist = local['hists'].get(key)
+        if hist is None:
+            hist = {
+                'latency': [0] * (len(self.m_latency_buckets) + 1),
+                'latency_sum': 0.0,
+                'throughput': [0] * (len(self.m_throughput_buckets) + 1),
+                'throughput_sum': 0.0,
+                'failed': 0,
+            }
+            local['hists'][key] = hist
+        hist['latency'][bisect.bisect_left(self.m_latency_buckets, seconds)] += 1
+        hist['latency_sum'] += seconds
+        rate = size / seconds if seconds > 0 else 0.0
+        hist['throughput'][bisect.bisect_left(self.m_throughput_buckets, rate)] += 1
+        hist['throughput_sum'] += rate
+        if ok is False:
+            hist['failed'] += 1
+        if self.m_events_fd is not None:
+            event = {'ts': round(time.time(), 6), 'op': op, 'path': path, 'size': size,
+                     'seconds': round(seconds, 6), 'ok': ok, 'thread': threading.current_thread().name}
+            local['events'].append(json.dumps(event) + '\n')
+            local['events_size'] += len(local['events'][-1])
+            if local['events_size'] >= self.m_event_buffer_size:
+                self.flush()
+
+    def flush(self):
+        '''
+        Append the events buffered by this thread to the event log.
+        '''
+        self._flush(self._get())
+
+    def close(self):
+        '''
+        Flush the events of all of the threads and close the event
+        log. The threads must be done.
+        '''
+        if self.m_events_fd is not None:
+            for local in self.m_threads:
+                self._flush(local)
+            os.close(self.m_events_fd)
+            self.m_events_fd = None
+
+    def write_prometheus(self, path, labels=None):
+        '''
+        Write the histograms in the Prometheus text format for the
+        node_exporter textfile collector. The file is written to a
+        temporary file and renamed so that the collector never sees a
+        partial file. The threads must be done.
+
+        @param path    The output file, it should end with .prom.
+        @param labels  Extra labels for every sample.
+        '''
+        merged = {}
+        for local in self.m_threads:
+            for key, hist in local['hists'].items():
+                total = merged.setdefault(key, {'latency': [0] * len(hist['latency']), 'latency_sum': 0.0,
+                                                'throughput': [0] * len(hist['throughput']),
+                                                'throughput_sum': 0.0, 'failed': 0})
+                for name in ['latency', 'throughput']:
+                    total[name] = [x + y for x, y in zip(total[name], hist[name])]
+                    total[name + '_sum'] += hist[name + '_sum']
+                total['failed'] += hist['failed']
+
+        lines = []
+        self._format_histogram(lines, merged, labels, 'latency', self.m_latency_buckets,
+                               'lock_files_file_duration_seconds', 'Time to process a file.')
+        self._format_histogram(lines, merged, labels, 'throughput', self.m_throughput_buckets,
+                               'lock_files_file_throughput_bytes_per_second',
+                               'Input bytes per second for a file.')
+        name = 'lock_files_files_failed_total'
+        lines.append('# HELP {} Files that could not be processed.'.format(name))
+        lines.append('# TYPE {} counter'.format(name))
+        for key in sorted(merged):
+            lines.append('{}{{{}}} {}'.format(name, self._format_labels(key, labels), merged[key]['failed']))
+        name = 'lock_files_last_run_timestamp_seconds'
+        lines.append('# HELP {} When the run finished.'.format(name))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{}{{{}}} {}'.format(name, self._format_labels(None, labels), round(time.time(), 3)))
+
+        tmp = get_tmp_path(os.path.abspath(path))
+        with open(tmp, 'w') as ofp:
+            ofp.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    def _format_histogram(self, lines, merged, labels, field, buckets, name, text):
+        '''
+        Format one histogram metric with a series for each operation
+        and size class.
+        '''
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for key in sorted(merged):
+            hist = merged[key]
+            base = self._format_labels(key, labels)
+            count = 0
+            for bound, num in zip(buckets + ['+Inf'], hist[field]):
+                count += num
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, base, bound, count))
+            lines.append('{}_sum{{{}}} {}'.format(name, base, repr(hist[field + '_sum'])))
+            lines.append('{}_count{{{}}} {}'.format(name, base, count))
+
+    def _format_labels(self, key, labels):
+        '''
+        Format the labels of a series.
+        '''
+        items = [] if key is None else [('op', key[0]), ('size_class', key[1])]
+        items += sorted((labels or {}).items())
+        return ','.join('{}="{}"'.format(k, v) for k, v in items)
+
+    def _get_size_class(self, size):
+        '''
+        Get the size class label of a file size.
+        '''
+        for bound, label in self.m_size_classes:
+            if bound is None or size < bound:
+                return label
+
+    def _get(self):
+        '''
+        Get the state of this thread, creating it on first use.
+        '''
+        local = getattr(self.m_local, 'state', None)
+        if local is None:
+            local = {'hists': {}, 'events': [], 'events_size': 0}
+            self.m_local.state = local
+            with self.m_mutex:
+                self.m_threads.append(local)
+        return local
+
+    def _flush(self, local):
+        '''
+        Append the buffered events of a thread to the event log.
+        '''
+        if self.m_events_fd is not None and local['events']:
+            data = ''.join(local['events']).encode('utf-8', 'surrogateescape')
+            local['events'] = []
+            local['events_size'] = 0
+            while data:
+                data = data[os.write(self.m_events_fd, data):]
+
+
+# ================================================================
+#
+# Message Utility Functions.
+#
+# ================================================================
+def _msg(prefix, msg, level, ofp):
+    '''
+    Thread safe message reporting.
+    '''
+    th_mutex.acquire()
+    try:
+        ofp.write('{}:{} {}\n'.format(prefix, inspect.stack()[level][2], msg))
+    finally:
+        th_mutex.release()
+
+
+def info(msg, level=1, ofp=sys.stdout):
+    '''
+    Display a simple information message with context information.
+    '''
+    _msg('INFO', msg, level+1, ofp)
+
+
+def infov(opts, msg, level=1, ofp=sys.stdout):
+    '''
+    Display a simple information message with context information.
+    '''
+    if opts.verbose:
+        _msg('INFO', msg, level+1, ofp)
+
+
+def infov2(opts, msg, level=1, ofp=sys.stdout):
+    '''
+    Display a simple information message with context information.
+    '''
+    if opts.verbose > 1:
+        _msg('INFO', msg, level+1, ofp)
+
+
+def err(msg, level=1, ofp=sys.stdout):
+    '''
+    Display error message with context information and exit.
+    '''
+    _msg('ERROR', msg, level+1, ofp)
+    abort_threads()
+    sys.exit(1)
+
+
+def errn(msg, level=1, ofp=sys.stdout):
+    '''
+    Display error message with context information but do not exit.
+    '''
+    _msg('ERROR', msg, level+1, ofp)
+
+
+def warn(msg, level=1, ofp=sys.stdout):
+    '''
+    Display error message with context information but do not exit.
+    '''
+    _msg('WARNING', msg, level+1, ofp)
+
+
+def _println(msg, ofp=sys.stdout):
+    '''
+    Print a message with a new line.
+    '''
+    th_mutex.acquire()
+    try:
+        ofp.write(msg + '\n')
+    finally:
+        th_mutex.release()
+
+
+# ================================================================
+#
+# Thread utility functions.
+#
+# ================================================================
+def abort_threads():
+    '''
+    Set the abort flag.
+    '''
+    th_mutex.acquire()
+    try:
+        global th_abort
+        th_abort = True
+    finally:
+        th_mutex.release()
+
+
+def get_num_cores():
+    '''
+    Get the number of available cores.
+    Unforunately, multiprocessing.cpu_count() uses _NPROCESSORS_ONLN
+    which may be different than the actual number of cores available
+    if power saving mode is enabled.
+
+    On Linux and Mac we can use "getconf _NPROCESSORS_CONF", I have
+    no idea how to get it on windows, maybe some WMIC call.
+    '''
+    if os.name == 'posix':
+        # should be able to run getconf.
+        try:
+            out = subprocess.check_output('getconf _NPROCESSORS_CONF', stderr=subprocess.STDOUT, shell=True)
+            return int(out.strip())
+        except subprocess.CallProcessError as exc:
+            err('command failed: {}'.format(exc))
+
+    return multiprocessing.cpu_count()
+
+
+def get_available_memory():
+    '''
+    Get the memory that is available without swapping.
+
+    On Linux, MemAvailable from /proc/meminfo is used because it
+    includes the page cache that can be reclaimed. Otherwise the
+    number of free physical pages is used. If neither is available,
+    assume 2GB.
+    '''
+    try:
+        with open('/proc/meminfo') as ifp:
+            for line in ifp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 2 * 1024 * 1024 * 1024
+
+
+def thread_worker(opts, password, stats):
+    '''
+    Thread worker.
+
+    Processes the batches of files in the queue until it gets None.
+    The statistics of a batch are published when it is done.
+    '''
+    batch_stats = BatchStats()
+    while True:
+        batch = th_queue.get()
+        if batch is None:
+            break
+        try:
+            for path, size in batch:
+                try:
+                    process_file(opts, password, path, batch_stats, size)
+                except SystemExit:
+                    pass  # err() reported the problem and set the abort flag
+                except Exception as exc:  # pylint: disable=broad-except
+                    errn('failed to process "{}": {}'.format(path, exc))
+                    if opts.warn is False:
+                        abort_threads()
+        finally:
+            batch_stats.publish(stats)
+        if th_metrics is not None and th_queue.empty():
+            th_metrics.flush()  # idle, do not hold events back
+
+
+def wait_for_threads():
+    '''
+    Wait for threads to complete.
+    '''
+    for th in threading.enumerate():
+        if th == threading.current_thread():
+            continue
+        th.join()
+
+
+# ================================================================
+#
+# Program specific functions.
+#
+# ================================================================
+def get_err_fct(opts):
+    '''
+    Get the message function: error or warning depending on
+    the --warn setting.
+    '''
+    if opts.warn is True:
+        return warn
+    if opts.verify is True:
+        return errn  # report every file that fails
+    return err
+
+
+def get_cipher(opts):
+    '''
+    Get the cipher object for the format specified by the options.
+    Each thread reuses its cipher object for all of its files.
+    '''
+    if getattr(th_local, 'cipher_opts', None) is not opts:
+        th_local.cipher = AESCipher(openssl=opts.openssl, kdf=opts.kdf, cost=opts.kdf_cost, hash=opts.hash)
+        th_local.cipher_opts = opts
+    return th_local.cipher
+
+
+def stat_inc(stats, key, value=1):
+    '''
+    Increment the stat in a synchronous way using a mutex
+    to coordinate between threads. The BatchStats of a worker
+    do not need it.
+    '''
+    if isinstance(stats, BatchStats):
+        stats[key] += value
+        return
+    th_mutex.acquire()
+    try:
+        stats[key] += value
+    finally:  # avoid deadlock from exception
+        th_mutex.release()
+
+
+def check_existence(opts, path):
+    '''
+    Check to see if a file exists.
+    If -o or --overwrite is specified, we don't care if it exists.
+    '''
+    if opts.overwrite is False and os.path.exists(path):
+        get_err_fct(opts)('file exists, cannot continue: {}'.format(path))
+
+
+def read_file(opts, path, stats):
+    '''
+    Read the file contents.
+    '''
+    try:
+        with open(path, 'rb') as ifp:
+            data = ifp.read()
+            stat_inc(stats, 'read', len(data))
+            return data
+    except IOError as exc:
+        get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc))
+        return None
+
+
+def write_file(opts, path, content, stats, width=0, sync=False, exclusive=False):
+    '''
+    Write the file.
+    If sync is True, wait until the content is on disk.
+
+    @param width      The line width, 0 for no line breaks.
+    @param exclusive  Create the file exclusively unless --overwrite
+                      was specified. It replaces check_existence()
+                      with a single system call. With --warn an
+                      existing file is reported and then truncated
+                      like check_existence() does.
+    '''
+    try:
+        if exclusive is True and opts.overwrite is False:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+            ofp = os.fdopen(os.open(path, flags, 0o666), 'wb')
+        else:
+            ofp = open(path, 'wb')
+        with ofp:
+            if width < 1:
+                ofp.write(content)
+            else:
+                # Write the lines in blocks rather than one at a time.
+                nl = '\n' if isinstance(content, str) else b'\n'
+                step = width * max(1, CHUNK_SIZE // width)
+                for i in range(0, len(content), step):
+                    block = content[i:i+step]
+                    ofp.write(nl.join([block[j:j+width] for j in range(0, len(block), width)]) + nl)
+            if sync is True:
+                ofp.flush()
+                os.fsync(ofp.fileno())
+            stat_inc(stats, 'written', len(content))
+    except IOError as exc:
+        if exc.errno == errno.EEXIST and exclusive is True:
+            get_err_fct(opts)('file exists, cannot continue: {}'.format(path))
+            if opts.warn is True:
+                return write_file(opts, path, content, stats, width, sync)
+        else:
+            get_err_fct(opts)('failed to write file "{}": {}'.format(path, exc))
+        return False
+    return True
+
+
+def get_tmp_path(out):
+    '''
+    Get the temporary file that an output is written to before it is
+    renamed. It is hidden so that it is never processed.
+    '''
+    return os.path.join(os.path.dirname(out), '.' + os.path.basename(out) + '.lftmp')
+
+
+def sync_dir(path):
+    '''
+    Wait until the directory entries of a file, e.g. a rename, are on
+    disk. It does nothing on systems that cannot open directories.
+
+    @param path  A file in the directory.
+    '''
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # not supported for directories
+    finally:
+        os.close(fd)
+
+
+def write_output(opts, path, out, stats, write, atomic=False):
+    '''
+    Write the output of a lock or unlock operation and remove the
+    input.
+
+    If there is a journal or atomic is True, the output is written to
+    a temporary file that is renamed when it is complete so that an
+    interrupted run never leaves a partial output under the final
+    name.
+
+    @param path    The input file.
+    @param out     The output file.
+    @param write   Function that writes the output to the file it is
+                   passed, syncing it to disk if the second argument
+                   is True. It returns True if it succeeded.
+    @param atomic  Always use a temporary file.
+    '''
+    if th_journal is None and atomic is False:
+        if write(out, False) is True and th_abort is False:
+            if out != path:
+                os.remove(path)  # remove the input
+            return True
+        return False
+
+    tmp = get_tmp_path(out) if th_journal is None else th_journal.begin(path, out)
+    try:
+        if write(tmp, th_journal is not None) is True and th_abort is False:
+            os.replace(tmp, out)
+            if th_journal is not None:
+                sync_dir(out)
+                th_journal.renamed(path)
+            if out != path:
+                os.remove(path)  # remove the input
+            if th_journal is not None:
+                th_journal.done(path, out)
+            return True
+        return False
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)  # failed or aborted
+
+
+def stream_to_file(opts, path, out, stream, sync=False):
+    '''
+    Lock, unlock or rekey a file to another file in chunks so that the
+    memory used does not depend on the size of the file.
+    If sync is True, wait until the output is on disk.
+
+    @param stream  Function that processes the input file object to
+                   the output file object, like stream_file(). It
+                   returns True if it succeeded.
+    '''
+    try:
+        with open(path, 'rb') as ifp:
+            with open(out, 'wb') as ofp:
+                if stream(ifp, ofp) is False:
+                    return False
+                if sync is True:
+                    os.fsync(ofp.fileno())
+                return True
+    except IOError as exc:
+        get_err_fct(opts)('failed to stream file "{}" --> "{}": {}'.format(path, out, exc))
+        return False
+
+
+def reserve_memory(opts, path, stats, size=None):
+    '''
+    Reserve the memory needed to process a file in memory.
+
+    Files that would need more than the fair share of a worker, the
+    --max-memory budget divided by --jobs, are streamed instead so
+    they cannot starve the other workers.
+
+    @param size  The size of the file if it is known from the scan.
+    @returns the number of bytes reserved or None if the file must
+             be streamed.
+    '''
+    if size is None:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0  # let read_file() report the problem
+    num = MEMORY_FACTOR * size + CHUNK_SIZE
+    if num > th_budget.m_size // opts.jobs:
+        stat_inc(stats, 'streamed')
+        return None
+    th_budget.reserve(num)
+    return num
+
+
+def stream_output(opts, password, path, out, stats, name=None, digests=None):
+    '''
+    Lock or unlock a file that is too large to process in memory to
+    its output in chunks.
+
+    @param name     The plaintext file to check against the --manifest.
+    @param digests  List that the content hash is appended to.
+    @returns True if the output was written.
+    '''
+    def stream(ifp, ofp):
+        return stream_file(opts, password, ifp, ofp, stats, name, digests)
+
+    def write(tmp, sync):
+        return stream_to_file(opts, path, tmp, stream, sync)
+    return write_output(opts, path, out, stats, write, atomic=True)
+
+
+def write_content(opts, path, out, content, stats, width=0):
+    '''
+    Write the locked or unlocked content of a file to its output. The
+    output is created exclusively, see write_file().
+
+    @param width  The line width, 0 for no line breaks.
+    @returns True if the output was written.
+    '''
+    def write(tmp, sync):
+        return write_file(opts, tmp, content, stats, width, sync, tmp == out)
+    return write_output(opts, path, out, stats, write)
+
+
+def lock_file(opts, password, path, stats, size=None):
+    '''
+    Lock a file.
+
+    @param size  The size of the file if it is known from the scan.
+    @returns True if the file was processed, False if it failed or
+             None if it was skipped.
+    '''
+    out = path + opts.suffix
+    infov2(opts, 'lock "{}" --> "{}"'.format(path, out))
+    reserved = reserve_memory(opts, path, stats, size)
+    if reserved is None:
+        check_existence(opts, out)
+        digests = []
+        if stream_output(opts, password, path, out, stats, digests=digests) is True:
+            if th_manifest is not None:
+                th_manifest.update(path, digests[0])
+            stat_inc(stats, 'locked')
+            return True
+        return False
+    try:
+        if th_journal is not None:
+            check_existence(opts, out)  # otherwise write_file() creates the output exclusively
+        content = read_file(opts, path, stats)
+        if content is not None:
+            cipher = get_cipher(opts)
+            width = 0 if cipher.m_binary else opts.wll
+            data = cipher.encrypt(password, content)
+            if data is not None and write_content(opts, path, out, data, stats, width) is True:
+                if th_manifest is not None:
+                    th_manifest.update(path, cipher.m_content_digest)
+                stat_inc(stats, 'locked')
+                return True
+        return False
+    finally:
+        th_budget.release(reserved)
+
+
+def unlock_file(opts, password, path, stats, size=None):
+    '''
+    Unlock a file.
+
+    @param size  The size of the file if it is known from the scan.
+    @returns True if the file was processed, False if it failed or
+             None if it was skipped.
+    '''
+    if path.endswith(opts.suffix):
+        if len(opts.suffix) > 0:
+            out = path[:-len(opts.suffix)]
+        else:
+            out = path
+        infov2(opts, 'unlock "{}" --> "{}"'.format(path, out))
+        if th_dedup is not None:
+            address = th_dedup.read_reference(path, size)
+            if address is not None:
+                return dedup_unlock_file(opts, password, path, out, address, stats)
+        reserved = reserve_memory(opts, path, stats, size)
+        if reserved is None:
+            check_existence(opts, out)
+            if stream_output(opts, password, path, out, stats, name=out) is True:
+                stat_inc(stats, 'unlocked')
+                return True
+            return False
+        try:
+            if th_journal is not None:
+                check_existence(opts, out)  # otherwise write_file() creates the output exclusively
+            content = read_file(opts, path, stats)
+            if content is not None and th_abort is False:
+                try:
+                    cipher = get_cipher(opts)
+                    data = cipher.decrypt(password, content)
+                    if th_manifest is not None:
+                        th_manifest.update(out, cipher.m_content_digest)
+                    if write_content(opts, path, out, data, stats) is True:
+                        stat_inc(stats, 'unlocked')
+                        return True
+                except ValueError as exc:
+                    get_err_fct(opts)('unlock/decrypt operation failed for "{}": {}'.format(path, exc))
+            return False
+        finally:
+            th_budget.release(reserved)
+    else:
+        infov2(opts, 'skip "{}"'.format(path))
+        stat_inc(stats, 'skipped')
+        return None
+
+
+def hash_file(opts, path, stats):
+    '''
+    Get the SHA-256 of a file, reading it in chunks.
+
+    @returns the digest or None if the file could not be read.
+    '''
+    hasher = hashlib.sha256()
+    buf = th_buffers.acquire(CHUNK_SIZE)
+    view = memoryview(buf)[:CHUNK_SIZE]
+    try:
+        with open(path, 'rb') as ifp:
+            while th_abort is False:
+                num = ifp.readinto(view)
+                if not num:
+                    return hasher.digest()
+                stat_inc(stats, 'read', num)
+                hasher.update(view[:num])
+    except IOError as exc:
+        get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc))
+    finally:
+        view.release()
+        th_buffers.release(buf)
+    return None
+
+
+def dedup_lock_file(opts, password, path, stats, size=None):
+    '''
+    Lock a file into the --dedup store.
+
+    The file is hashed first. If the store does not have its content
+    yet, it is locked into the store. The locked file is a reference
+    to the content in the store.
+
+    @param size  The size of the file if it is known from the scan.
+    @returns True if the file was processed or False if it failed.
+    '''
+    out = path + opts.suffix
+    infov2(opts, 'lock "{}" --> "{}" (dedup)'.format(path, out))
+    check_existence(opts, out)
+    digest = hash_file(opts, path, stats)
+    if digest is None or th_abort is True:
+        return False
+    address = th_dedup.address(digest)
+
+    def stream(ifp, ofp):
+        return stream_file(opts, password, ifp, ofp, stats)
+
+    def store(tmp):
+        return stream_to_file(opts, path, tmp, stream, True)
+    stored = th_dedup.add(address, store)
+    if stored is None:
+        return False
+    if stored is False:
+        stat_inc(stats, 'deduped')
+        stat_inc(stats, 'saved', os.path.getsize(path) if size is None else size)
+    if write_content(opts, path, out, th_dedup.reference(address), stats) is True:
+        stat_inc(stats, 'locked')
+        return True
+    return False
+
+
+def dedup_stream(opts, password, path, address, ifp, ofp, stats):
+    '''
+    Unlock the content of an address in the --dedup store to a stream
+    and check that it matches the address.
+
+    @param path  The locked file that refers to the address.
+    @returns True if the operation succeeded.
+    '''
+    writer = HashWriter(ofp)
+    if stream_file(opts, password, ifp, writer, stats) is False:
+        return False
+    if not th_dedup.check(address, writer.m_hasher.digest()):
+        get_err_fct(opts)('unlock/decrypt operation failed for "{}": '
+                          'the content does not match its address'.format(path))
+        return False
+    return True
+
+
+def dedup_unlock_file(opts, password, path, out, address, stats):
+    '''
+    Unlock a reference to the --dedup store. The content stays in the
+    store because other files can refer to it.
+
+    @param path     The locked file.
+    @param out      The unlocked file.
+    @param address  The address that the locked file refers to.
+    @returns True if the file was processed or False if it failed.
+    '''
+    obj = th_dedup.object_path(address)
+    if not os.path.exists(obj):
+        get_err_fct(opts)('unlock/decrypt operation failed for "{}": '
+                          'the content is not in the store: {}'.format(path, obj))
+        return False
+    check_existence(opts, out)
+
+    def stream(ifp, ofp):
+        return dedup_stream(opts, password, path, address, ifp, ofp, stats)
+
+    def write(tmp, sync):
+        return stream_to_file(opts, obj, tmp, stream, sync)
+    if write_output(opts, path, out, stats, write, atomic=True) is True:
+        stat_inc(stats, 'unlocked')
+        return True
+    return False
+
+
+def stream_file(opts, password, ifp, ofp, stats, name=None, digests=None):
+    '''
+    Lock or unlock a stream in chunks so that the memory used does
+    not depend on the size of the input.
+
+    @param ifp      The binary input file object.
+    @param ofp      The binary output file object.
+    @param name     The plaintext file to check against the --manifest
+                    when unlocking or verifying.
+    @param digests  List that the content hash is appended to so that
+                    the caller can add it to the --manifest once the
+                    output is committed.
+    @returns True if the operation succeeded.
+    '''
+    cipher = get_cipher(opts)
+    stream = None
+    buf = th_buffers.acquire(CHUNK_SIZE)
+    view = memoryview(buf)[:CHUNK_SIZE]
+    try:
+        if opts.lock is True:
+            stream = AESStreamEncryptor(cipher, password)
+            writer = LineWriter(ofp, 0 if cipher.m_binary else opts.wll)
+        else:
+            stream = AESStreamDecryptor(cipher, password)
+            writer = LineWriter(ofp)
+        while th_abort is False:
+            num = ifp.readinto(view)
+            if not num:
+                data = stream.finalize()
+                if th_manifest is not None and name is not None and opts.lock is False:
+                    th_manifest.update(name, stream.m_digest)
+                if digests is not None:
+                    digests.append(stream.m_digest)
+                writer.write(data)
+                writer.close()
+                if opts.verify is False:
+                    stat_inc(stats, 'written', writer.m_size)
+                return True
+            stat_inc(stats, 'read', num)
+            writer.write(stream.update(view[:num]))
+    except ValueError as exc:
+        action = 'lock/encrypt' if opts.lock is True else 'unlock/decrypt'
+        get_err_fct(opts)('{} operation failed for "{}": {}'.format(action, getattr(ifp, 'name', '-'), exc))
+    except IOError as exc:
+        get_err_fct(opts)('stream operation failed: {}'.format(exc))
+    finally:
+        if stream is not None:
+            stream.close()
+        view.release()
+        th_buffers.release(buf)
+    return False
+
+
+def get_rekey_ciphers(opts, header):
+    '''
+    Get the ciphers that read and write a file that is rekeyed.
+
+    The input format is defined by the options in the same way as for
+    --unlock. The output format is the binary format with the
+    --rekey-kdf KDF if it was specified, otherwise it is the same as
+    the input format. A file in the binary format keeps its KDF, cost
+    and content hash unless --hash was specified.
+
+    @param header  The start of the locked data.
+    @returns the input and the output ciphers.
+    '''
+    cost = None if opts.rekey_kdf else opts.kdf_cost  # -K belongs to --rekey-kdf
+    source = AESCipher(openssl=opts.openssl, kdf=opts.kdf, cost=cost)
+    binary = source.is_binary(header)
+    content_hash = opts.hash or (source.get_binary_hash(header) if binary else None)
+    if opts.rekey_kdf:
+        return source, AESCipher(kdf=opts.rekey_kdf, cost=opts.kdf_cost, hash=content_hash)
+    if binary:
+        kdf, cost = source.get_binary_kdf(header)
+        return source, AESCipher(kdf=kdf, cost=cost, hash=content_hash)
+    return source, source
+
+
+def rekey_stream(opts, password, new_password, ifp, ofp, stats):
+    '''
+    Decrypt a stream with the old password and encrypt it with the
+    new password in a single pass. The plaintext only exists in the
+    memory of this thread, one chunk at a time.
+
+    @param ifp  The binary input file object.
+    @param ofp  The binary output file object.
+    @returns True if the operation succeeded.
+    '''
+    decryptor = None
+    encryptor = None
+    buf = th_buffers.acquire(CHUNK_SIZE)
+    view = memoryview(buf)[:CHUNK_SIZE]
+    try:
+        num = ifp.readinto(view)
+        source, target = get_rekey_ciphers(opts, view[:num])
+        decryptor = AESStreamDecryptor(source, password)
+        encryptor = AESStreamEncryptor(target, new_password)
+        writer = LineWriter(ofp, 0 if target.m_binary else opts.wll)
+        while th_abort is False:
+            if not num:
+                writer.write(encryptor.finalize(decryptor.finalize()))
+                writer.close()
+                stat_inc(stats, 'written', writer.m_size)
+                return True
+            stat_inc(stats, 'read', num)
+            writer.write(encryptor.update(decryptor.update(view[:num])))
+            num = ifp.readinto(view)
+    except ValueError as exc:
+        get_err_fct(opts)('rekey operation failed for "{}": {}'.format(getattr(ifp, 'name', '-'), exc))
+    except IOError as exc:
+        get_err_fct(opts)('stream operation failed: {}'.format(exc))
+    finally:
+        for stream in [decryptor, encryptor]:
+            if stream is not None:
+                stream.close()
+        view.release()
+        th_buffers.release(buf)
+    return False
+
+
+def unlock_layers_stream(opts, passwords, ifp, ofp, stats):
+    '''
+    Remove every layer of a file that was locked more than once in a
+    single pass. The decryptors are chained so that the output of
+    each layer is the input of the layer below it and only the final
+    plaintext is written.
+
+    @param passwords  The password of each layer, outermost first.
+    @param ifp        The binary input file object.
+    @param ofp        The binary output file object.
+    @returns True if the operation succeeded.
+    '''
+    cipher = get_cipher(opts)
+    streams = []
+    buf = th_buffers.acquire(CHUNK_SIZE)
+    view = memoryview(buf)[:CHUNK_SIZE]
+    try:
+        for password in passwords:
+            streams.append(AESStreamDecryptor(cipher, password))
+        writer = LineWriter(ofp)
+        while th_abort is False:
+            num = ifp.readinto(view)
+            if not num:
+                data = b''
+                for stream in streams:
+                    data = stream.finalize(data)
+                writer.write(data)
+                writer.close()
+                stat_inc(stats, 'written', writer.m_size)
+                return True
+            stat_inc(stats, 'read', num)
+            data = view[:num]
+            for stream in streams:
+                data = stream.update(data)
+            writer.write(data)
+    except ValueError as exc:
+        name = getattr(ifp, 'name', '-')
+        get_err_fct(opts)('unlock/decrypt operation failed for "{}": {}'.format(name, exc))
+    except IOError as exc:
+        get_err_fct(opts)('stream operation failed: {}'.format(exc))
+    finally:
+        for stream in streams:
+            stream.close()
+        view.release()
+        th_buffers.release(buf)
+    return False
+
+
+def unlock_layers_file(opts, path, stats):
+    '''
+    Unlock a file that may have been locked more than once, removing
+    one suffix for each layer.
+
+    @returns True if the file was processed, False if it failed or
+             None if it was skipped.
+    '''
+    if not path.endswith(opts.suffix):
+        infov2(opts, 'skip "{}"'.format(path))
+        stat_inc(stats, 'skipped')
+        return None
+    out = path
+    layers = 0
+    while out.endswith(opts.suffix) and len(os.path.basename(out)) > len(opts.suffix):
+        out = out[:-len(opts.suffix)]
+        layers += 1
+    passwords = opts.layer_passwords
+    if len(passwords) == 1:
+        passwords = passwords * layers
+    elif len(passwords) < layers:
+        get_err_fct(opts)('"{}" has {} layers but there are only {} passwords'.format(path, layers,
+                                                                                   len(passwords)))
+        return False
+    infov2(opts, 'unlock {} layers "{}" --> "{}"'.format(layers, path, out))
+    check_existence(opts, out)
+    stream = lambda ifp, ofp: unlock_layers_stream(opts, passwords[:layers], ifp, ofp, stats)
+    if write_output(opts, path, out, stats,
+                    lambda tmp, sync: stream_to_file(opts, path, tmp, stream, sync),
+                    atomic=True) is True:
+        stat_inc(stats, 'unlocked')
+        stat_inc(stats, 'layers', layers)
+        return True
+    return False
+
+
+def rekey_file(opts, password, path, stats):
+    '''
+    Change the password of a locked file. The new file replaces the
+    old one atomically and the name does not change.
+
+    @returns True if the file was processed, False if it failed or
+             None if it was skipped.
+    '''
+    if not path.endswith(opts.suffix):
+        infov2(opts, 'skip "{}"'.format(path))
+        stat_inc(stats, 'skipped')
+        return None
+    infov2(opts, 'rekey "{}"'.format(path))
+    stream = lambda ifp, ofp: rekey_stream(opts, password, opts.rekey_password, ifp, ofp, stats)
+    if write_output(opts, path, path, stats,
+                    lambda tmp, sync: stream_to_file(opts, path, tmp, stream, sync),
+                    atomic=True) is True:
+        stat_inc(stats, 'rekeyed')
+        return True
+    return False
 
 
-def get_num_cores():
+def process_stream(opts, password, entry, stats):
     '''
-    Get the number of available cores.
-    Unforunately, multiprocessing.cpu_count() uses _NPROCESSORS_ONLN
-    which may be different than the actual number of cores available
-    if power saving mode is enabled.
+    Process an entry in stdout mode.
 
-    On Linux and Mac we can use "getconf _NPROCESSORS_CONF", I have
-    no idea how to get it on windows, maybe some WMIC call.
+    The output is written to stdout and the input is never removed.
+    If the entry is "-", the input is read from stdin.
     '''
-    if os.name == 'posix':
-        # should be able to run getconf.
+    stat_inc(stats, 'files')
+    infov2(opts, '{} "{}" --> stdout'.format('lock' if opts.lock is True else 'unlock', entry))
+    if entry == '-':
+        ifp = getattr(sys.stdin, 'buffer', sys.stdin)
+        ok = stream_file(opts, password, ifp, opts.stdout_fp, stats)
+    else:
         try:
-            out = subprocess.check_output('getconf _NPROCESSORS_CONF', stderr=subprocess.STDOUT, shell=True)
-            return int(out.strip())
-        except subprocess.CallProcessError as exc:
-            err('command failed: {}'.format(exc))
-
-    return multiprocessing.cpu_count()
+            with open(entry, 'rb') as ifp:
+                ok = stream_file(opts, password, ifp, opts.stdout_fp, stats)
+        except IOError as exc:
+            get_err_fct(opts)('failed to read file "{}": {}'.format(entry, exc))
+            return
+    if ok is True:
+        stat_inc(stats, 'locked' if opts.lock is True else 'unlocked')
 
 
-def thread_process_file(opts, password, entry, stats):
+def verify_file(opts, password, path, stats):
     '''
-    Thread worker.
+    Verify that a locked file can be unlocked by decrypting it to a
+    discarding sink. Nothing is written and the file is not changed.
+    The padding and, for the binary format, the password check value
+    are validated.
 
-    Waits for the semaphore to make a slot available, then
-    runs the specified function.
+    @returns True if the file was processed, False if it failed or
+             None if it was skipped.
     '''
-    if th_abort is False:
-        with th_semaphore:
-            process_file(opts, password, entry, stats)
+    if not path.endswith(opts.suffix):
+        infov2(opts, 'skip "{}"'.format(path))
+        stat_inc(stats, 'skipped')
+        return None
+    infov2(opts, 'verify "{}"'.format(path))
+    address = th_dedup.read_reference(path) if th_dedup is not None else None
+    try:
+        if address is None:
+            with open(path, 'rb') as ifp:
+                ok = stream_file(opts, password, ifp, NullFile(), stats, path[:len(path) - len(opts.suffix)])
+        else:
+            with open(th_dedup.object_path(address), 'rb') as ifp:
+                ok = dedup_stream(opts, password, path, address, ifp, NullFile(), stats)
+    except IOError as exc:
+        errn('failed to read file "{}": {}'.format(path, exc))
+        ok = False
+    if th_abort is True:
+        return False
+    if ok is True:
+        stat_inc(stats, 'verified')
+        infov(opts, '{}: OK'.format(path))
+    else:
+        stat_inc(stats, 'failed')
+        _println('{}: FAILED'.format(path))
+    return ok
 
 
-def wait_for_threads():
+def process_file(opts, password, path, stats, size=None):
     '''
-    Wait for threads to complete.
+    Process a file.
+
+    @param size  The size of the file if it is known from the scan.
     '''
-    for th in threading.enumerate():
-        if th == threading.currentThread():
-            continue
-        th.join()
+    if th_abort is False:
+        if th_journal is not None and th_journal.is_journal(path):
+            return
+        if th_journal is not None and th_journal.is_done(path):
+            infov2(opts, 'done by a previous run "{}"'.format(path))
+            stat_inc(stats, 'resumed')
+            return
+        stat_inc(stats, 'files')
+        if th_metrics is not None:
+            if size is None:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = 0
+            start = time.perf_counter()
+        ok = False
+        try:
+            if opts.verify is True:
+                ok = verify_file(opts, password, path, stats)
+            elif opts.rekey:
+                ok = rekey_file(opts, password, path, stats)
+            elif opts.all_layers is True:
+                ok = unlock_layers_file(opts, path, stats)
+            elif opts.lock is True and th_dedup is not None:
+                ok = dedup_lock_file(opts, password, path, stats, size)
+            elif opts.lock is True:
+                ok = lock_file(opts, password, path, stats, size)
+            else:
+                ok = unlock_file(opts, password, path, stats, size)
+        finally:
+            if th_metrics is not None and ok is not None:
+                th_metrics.record(get_action(opts), path, size, time.perf_counter() - start, ok)
 
 
-# ================================================================
-#
-# Program specific functions.
-#
-# ================================================================
-def get_err_fct(opts):
+def scan_dir(opts, path, sizes):
     '''
-    Get the message function: error or warning depending on
-    the --warn setting.
+    Scan a directory for files in case-insensitive name order,
+    recursing if --recurse was specified. Hidden files and the output
+    files of the program, e.g. the --manifest, are skipped.
+
+    @param path   The directory.
+    @param sizes  Get the file sizes from the directory scan.
+    @returns an iterator of (path, size) tuples, the size is None if
+             sizes is False.
     '''
-    if opts.warn is True:
-        return warn
-    return err
+    try:
+        entries = sorted(os.scandir(path), key=lambda e: e.name.lower())
+    except OSError as exc:
+        get_err_fct(opts)('failed to read directory "{}": {}'.format(path, exc))
+        return
+    subdirs = []
+    for entry in entries:
+        if th_abort is True:
+            return
+        if entry.is_dir():
+            if opts.recurse is True and not entry.is_symlink():
+                subdirs.append(entry.path)
+        elif entry.is_file() and not entry.name.startswith('.'):
+            if opts.outputs and os.path.abspath(entry.path) in opts.outputs:
+                continue
+            try:
+                yield entry.path, entry.stat().st_size if sizes else None
+            except OSError:
+                continue  # removed since the scan, e.g. by another shard
+    for subdir in subdirs:
+        for item in scan_dir(opts, subdir, sizes):
+            yield item
 
 
-def stat_inc(stats, key, value=1):
+def scan(opts, stats, sizes):
     '''
-    Increment the stat in a synchronous way using a mutex
-    to coordinate between threads.
+    Scan the entries on the command line for files.
+    They can be either files or directories.
+
+    If --shard was specified, only the files of this shard are
+    returned.
+
+    @param sizes  Get the file sizes from the directory scan.
+    @returns an iterator of (path, size) tuples, the size is None if
+             sizes is False.
     '''
-    th_mutex.acquire()
-    try:
-        stats[key] += value
-    finally:  # avoid deadlock from exception
-        th_mutex.release()
+    if opts.shard is None:
+        return ((path, size) for _, path, size in scan_roots(opts, stats, sizes))
+    if opts.shard_plan:
+        sizes = sizes or not os.path.exists(opts.shard_plan)
+        return select_planned_shard(opts, scan_roots(opts, stats, sizes))
+    return select_shard(opts, scan_roots(opts, stats, sizes))
 
 
-def check_existence(opts, path):
+def scan_roots(opts, stats, sizes):
     '''
-    Check to see if a file exists.
-    If -o or --overwrite is specified, we don't care if it exists.
+    Scan the entries on the command line for files.
+
+    @param sizes  Get the file sizes from the directory scan.
+    @returns an iterator of (key, path, size) tuples where the key is
+             the shard key of the file.
     '''
-    if opts.overwrite is False and os.path.exists(path):
-        get_err_fct(opts)('file exists, cannot continue: {}'.format(path))
+    for entry in opts.FILES:
+        if th_abort is True:
+            return
+        if os.path.isfile(entry):
+            size = os.path.getsize(entry) if sizes else None
+            yield get_shard_key(opts, os.path.dirname(entry), entry), entry, size
+        elif os.path.isdir(entry):
+            stats['dirs'] += 1
+            for path, size in scan_dir(opts, entry, sizes):
+                yield get_shard_key(opts, entry, path), path, size
 
 
-def read_file(opts, path, stats):
+def get_shard_key(opts, root, path):
     '''
-    Read the file contents.
+    Get the key that assigns a file to a shard.
+
+    It is the path relative to the root that was specified on the
+    command line so that it does not depend on where the tree is
+    mounted. The suffixes are removed so that a file and its locked
+    versions belong to the same shard, otherwise a shard could pick up
+    the output of another shard.
     '''
-    try:
-        with open(path, 'rb') as ifp:
-            data = ifp.read()
-            stat_inc(stats, 'read', len(data))
-            return data
-    except IOError as exc:
-        get_err_fct(opts)('failed to read file "{}": {}'.format(path, exc))
+    if opts.shard is None:
         return None
+    key = os.path.relpath(path, root or os.curdir).replace(os.sep, '/')
+    while opts.suffix and key.endswith(opts.suffix) and len(key) > len(opts.suffix):
+        key = key[:-len(opts.suffix)]
+    return key
 
 
-def write_file(opts, path, content, stats, width=0):
+def get_shard(key, count):
     '''
-    Write the file.
+    Get the shard of a key, a stable hash of the key modulo the
+    number of shards. The built-in hash() is randomized for each
+    process so it cannot be used.
+
+    @returns the shard index in the range [0..count-1].
     '''
-    try:
-        with open(path, 'wb') as ofp:
-            if width < 1:
-                ofp.write(content)
-            else:
-                i = 0
-                nl = '\n' if isinstance(content, str) else b'\n'
-                while i < len(content):
-                    ofp.write(content[i:i+width] + nl)
-                    i += width
-            stat_inc(stats, 'written', len(content))
-    except IOError as exc:
-        get_err_fct(opts)('failed to write file "{}": {}'.format(path, exc))
-        return False
-    return True
+    return struct.unpack('>Q', hashlib.md5(os.fsencode(key)).digest()[:8])[0] % count
 
 
-def lock_file(opts, password, path, stats):
+def select_shard(opts, entries):
     '''
-    Lock a file.
+    Select the files that belong to this shard by the hash of their
+    key. Each file is assigned independently so it works no matter
+    what the other shards have already done.
+
+    @param entries  Iterator of (key, path, size) tuples.
+    @returns an iterator of (path, size) tuples.
     '''
-    out = path + opts.suffix
-    infov2(opts, 'lock "{}" --> "{}"'.format(path, out))
-    check_existence(opts, out)
-    content = read_file(opts, path, stats)
-    if content is not None:
-        data = AESCipher(openssl=opts.openssl).encrypt(password, content)
-        if data is not None and write_file(opts, out, data, stats, width=opts.wll) is True and th_abort is False:
-            if out != path:
-                os.remove(path)  # remove the input
-            stat_inc(stats, 'locked')
+    index, count = opts.shard
+    for key, path, size in entries:
+        if get_shard(key, count) == index - 1:
+            yield path, size
 
 
-def unlock_file(opts, password, path, stats):
-    '''
-    Unlock a file.
+def select_planned_shard(opts, entries):
     '''
-    if path.endswith(opts.suffix):
-        if len(opts.suffix) > 0:
-            out = path[:-len(opts.suffix)]
-        else:
-            out = path
-        infov2(opts, 'unlock "{}" --> "{}"'.format(path, out))
-        check_existence(opts, out)
-        content = read_file(opts, path, stats)
-        if content is not None and th_abort is False:
-            try:
-                data = AESCipher(openssl=opts.openssl).decrypt(password, content)
-                if write_file(opts, out, data, stats) is True:
-                    if out != path:
-                        os.remove(path)  # remove the input
-                    stats['unlocked'] += 1
-            except ValueError as exc:
-                get_err_fct(opts)('unlock/decrypt operation failed for "{}": {}'.format(path, exc))
-    else:
-        infov2(opts, 'skip "{}"'.format(path))
-        stats['skipped'] += 1
+    Select the files that belong to this shard by the --shard-plan.
 
+    The first shard to start computes the plan from its scan and
+    publishes it atomically. The other shards use that plan rather
+    than their own scan because the files and their sizes change as
+    soon as a shard starts to process them. Files that are not in the
+    plan, because they were created later, are assigned by hash.
 
-def process_file(opts, password, path, stats):
+    @param entries  Iterator of (key, path, size) tuples.
+    @returns an iterator of (path, size) tuples.
     '''
-    Process a file.
+    index, count = opts.shard
+    plan = None
+    if not os.path.exists(opts.shard_plan):
+        entries = list(entries)
+        plan = make_shard_plan(entries, count)
+        tmp = get_tmp_path(os.path.abspath(opts.shard_plan)) + '.{}'.format(os.getpid())
+        with open(tmp, 'w') as ofp:
+            json.dump({'version': 1, 'count': count, 'shards': plan}, ofp)
+        try:
+            os.link(tmp, opts.shard_plan)  # fails if another shard was first
+            infov(opts, 'wrote shard plan "{}"'.format(opts.shard_plan))
+        except OSError:
+            plan = None
+        finally:
+            os.remove(tmp)
+    if plan is None:
+        with open(opts.shard_plan, 'r') as ifp:
+            data = json.load(ifp)
+        if data.get('count') != count:
+            err('shard plan "{}" is for {} shards, not {}'.format(opts.shard_plan, data.get('count'), count))
+        plan = data['shards']
+    for key, path, size in entries:
+        shard = plan.get(key)
+        if shard is None:
+            shard = get_shard(key, count)
+        if shard == index - 1:
+            yield path, size
+
+
+def make_shard_plan(entries, count):
     '''
-    if th_abort is False:
-        stat_inc(stats, 'files')
-        if opts.lock is True:
-            lock_file(opts, password, path, stats)
-        else:
-            unlock_file(opts, password, path, stats)
+    Assign the files to the shards so that each shard has about the
+    same number of bytes. The files are assigned largest first to
+    the shard with the fewest bytes so far (LPT).
 
-
-def process_dir(opts, password, path, stats):
+    @param entries  List of (key, path, size) tuples.
+    @returns a dictionary that maps each key to its shard index.
     '''
-    Process a directory, we always start at the top level.
+    sizes = {}
+    for key, _, size in entries:
+        sizes[key] = max(sizes.get(key, 0), size)  # a file and its locked version
+    loads = [(0, i) for i in range(count)]
+    plan = {}
+    for key, size in sorted(sizes.items(), key=lambda e: (-e[1], e[0])):
+        load, shard = heapq.heappop(loads)
+        plan[key] = shard
+        heapq.heappush(loads, (load + size, shard))
+    return plan
+
+
+def get_schedule(opts):
     '''
-    stats['dirs'] += 1
-    if opts.recurse is True:
-        # Recurse to get everything.
-        for root, subdirs, subfiles in os.walk(path):
-            for subfile in sorted(subfiles, key=str.lower):
-                if subfile.startswith('.'):
-                    continue
-                if th_abort is True:
-                    break
-                subpath = os.path.join(root, subfile)
-                th = Thread(target=thread_process_file, args=(opts, password, subpath, stats))
-                th.daemon = True
-                th.start()
-    else:
-        # Use listdir() to get the files in the current directory only.
-        for entry in sorted(os.listdir(path), key=str.lower):
-            if entry.startswith('.'):
-                continue
-            subpath = os.path.join(path, entry)
-            if os.path.isfile(subpath):
-                if th_abort is True:
-                    break
-                th = Thread(target=thread_process_file, args=(opts, password, subpath, stats))
-                th.daemon = True
-                th.start()
+    Get the effective --schedule policy.
+    The order does not matter for a single worker so auto uses
+    name order to avoid holding the whole file list in memory.
+    '''
+    if opts.schedule == 'auto' and opts.jobs < 2:
+        return 'name'
+    return opts.schedule
 
 
-def process(opts, password, entry, stats):
+def schedule(opts, entries):
     '''
-    Process an entry.
+    Order the files for the workers using the --schedule policy.
 
-    If it is a file, then operate on it.
+    name: the scan order.
+    size: largest first (LPT) so that a large file is never started
+          last while the other workers sit idle.
+    auto: the largest file for each worker first, then alternate
+          between the smallest and the largest remaining files so
+          that I/O bound small files overlap CPU bound large files.
 
-    If it is a directory, recurse if --recurse was specified.
+    @param entries  Iterator of (path, size) tuples from scan().
+    @returns an iterator of (path, size) tuples.
     '''
-    if th_abort is False:
-        if os.path.isfile(entry):
-            th = Thread(target=thread_process_file, args=(opts, password, entry, stats))
-            th.daemon = True
-            th.start()
-        elif os.path.isdir(entry):
-            process_dir(opts, password, entry, stats)
+    policy = get_schedule(opts)
+    if policy == 'name':
+        return entries
+
+    # Python sorts are stable so files of the same size stay in name order.
+    ordered = sorted(entries, key=lambda e: e[1], reverse=True)
+    if policy == 'size':
+        return ordered
+    result = ordered[:opts.jobs]
+    lo = opts.jobs
+    hi = len(ordered) - 1
+    while lo <= hi:
+        result.append(ordered[hi])
+        hi -= 1
+        if lo <= hi:
+            result.append(ordered[lo])
+            lo += 1
+    return result
+
+
+def batch(entries):
+    '''
+    Group the small files into batches for the workers so that the
+    queue and the statistics are synchronized once per batch rather
+    than once per file. A batch is closed when it has BATCH_FILES
+    files or BATCH_BYTES bytes. Files that are larger than
+    SMALL_FILE_SIZE are a batch on their own so that they are still
+    spread over the workers. The files keep the order of the schedule:
+    the pending small files are sent before a large file.
+
+    @param entries  Iterator of (path, size) tuples from schedule().
+    @returns an iterator of lists of (path, size) tuples.
+    '''
+    items = []
+    total = 0
+    for path, size in entries:
+        if size > SMALL_FILE_SIZE:
+            if items:
+                yield items
+                items = []
+                total = 0
+            yield [(path, size)]
+            continue
+        items.append((path, size))
+        total += size
+        if len(items) >= BATCH_FILES or total >= BATCH_BYTES:
+            yield items
+            items = []
+            total = 0
+    if items:
+        yield items
 
 
 def run(opts, password, stats):
     '''
     Process the entries on the command line.
     They can be either files or directories.
+
+    The files are scanned, ordered by the --schedule policy and
+    processed in batches by a pool of --jobs worker threads.
     '''
-    for entry in opts.FILES:
-        process(opts, password, entry, stats)
+    if opts.stdout is True:
+        process_stream(opts, password, opts.FILES[0], stats)
+        return
+
+    global th_queue
+    th_queue = queue.Queue(maxsize=4 * opts.jobs)
+    for _ in range(opts.jobs):
+        th = Thread(target=thread_worker, args=(opts, password, stats))
+        th.daemon = True
+        th.start()
+
+    try:
+        # The sizes are needed for the batches, the workers use them
+        # rather than getting them again.
+        for items in batch(schedule(opts, scan(opts, stats, True))):
+            if th_abort is True:
+                break
+            th_queue.put(items)
+    except KeyboardInterrupt:
+        abort_threads()  # let the workers drain the queue quickly
+        raise
+    finally:
+        for _ in range(opts.jobs):
+            th_queue.put(None)
+
+
+def get_action(opts):
+    '''
+    Get the name of the operation: lock, unlock, verify or rekey.
+    '''
+    if opts.verify is True:
+        return 'verify'
+    if opts.rekey:
+        return 'rekey'
+    return 'lock' if opts.lock is True else 'unlock'
+
+
+def write_stats(opts, stats):
+    '''
+    Write the statistics to the --stats file as JSON.
+
+    The counters are additive so the files of all of the shards of a
+    run can be merged by adding them up.
+    '''
+    data = {
+        'version': VERSION,
+        'action': get_action(opts),
+        'shard': '{}/{}'.format(*opts.shard) if opts.shard else None,
+        'aborted': th_abort,
+        'roots': stats['dirs'],
+        'counters': dict((key, val) for key, val in stats.items() if key != 'dirs'),
+    }
+    tmp = get_tmp_path(os.path.abspath(opts.stats))
+    try:
+        with open(tmp, 'w') as ofp:
+            json.dump(data, ofp, indent=2, sort_keys=True)
+            ofp.write('\n')
+        os.replace(tmp, opts.stats)
+    except (IOError, OSError) as exc:
+        errn('failed to write the stats file "{}": {}'.format(opts.stats, exc))
 
 
 def summary(opts, stats):
@@ -653,22 +3062,46 @@ def summary(opts, stats):
     have completed.
     '''
     if opts.verbose:
-        action = 'lock' if opts.lock is True else 'unlock'
         print('')
         print('Setup')
-        print('   action:              {:>12}'.format(action))
+        print('   action:              {:>12}'.format(get_action(opts)))
         print('   inplace:             {:>12}'.format(str(opts.inplace)))
         print('   jobs:                {:>12,}'.format(opts.jobs))
+        print('   max memory:          {:>12,}'.format(opts.max_memory))
+        if opts.dedup:
+            print('   dedup:               {:>12}'.format(opts.dedup))
+        if opts.hash:
+            print('   hash:                {:>12}'.format(opts.hash))
+        if opts.kdf:
+            print('   kdf:                 {:>12}'.format(opts.kdf))
+        if opts.rekey_kdf:
+            print('   rekey kdf:           {:>12}'.format(opts.rekey_kdf))
         print('   overwrite:           {:>12}'.format(str(opts.overwrite)))
+        print('   schedule:            {:>12}'.format(get_schedule(opts)))
+        if opts.shard:
+            print('   shard:               {:>12}'.format('{}/{}'.format(*opts.shard)))
         print('   suffix:              {:>12}'.format('"' + opts.suffix + '"'))
         print('')
         print('Summary')
         print('   total files:         {:>12,}'.format(stats['files']))
         if opts.lock:
             print('   total locked:        {:>12,}'.format(stats['locked']))
-        if opts.unlock:
+        if opts.verify:
+            print('   total verified:      {:>12,}'.format(stats['verified']))
+            print('   total failed:        {:>12,}'.format(stats['failed']))
+        elif opts.rekey:
+            print('   total rekeyed:       {:>12,}'.format(stats['rekeyed']))
+        elif opts.unlock:
             print('   total unlocked:      {:>12,}'.format(stats['unlocked']))
+            if opts.all_layers:
+                print('   total layers:        {:>12,}'.format(stats['layers']))
         print('   total skipped:       {:>12,}'.format(stats['skipped']))
+        if opts.journal:
+            print('   total resumed:       {:>12,}'.format(stats['resumed']))
+        print('   total streamed:      {:>12,}'.format(stats['streamed']))
+        if opts.dedup and opts.lock:
+            print('   total deduplicated:  {:>12,}'.format(stats['deduped']))
+            print('   total bytes saved:   {:>12,}'.format(stats['saved']))
         print('   total bytes read:    {:>12,}'.format(stats['read']))
         print('   total bytes written: {:>12,}'.format(stats['written']))
         print('')
@@ -694,20 +3127,7 @@ def get_password(opts):
 
     # User specified the password in a file. It should be 0600.
     if opts.password_file:
-        if not os.path.exists(opts.password_file):
-            err("password file doesn't exist: {}".format(opts.password_file))
-        password = None
-        with open(opts.password_file, 'rb') as ifp:
-            for line in ifp.readlines():
-                # leading and trailing white space not allowed
-                line = line.strip()
-                # skip empty and comment lines
-                if line and line[0] != '#':
-                    password = line
-                    break
-        if password is None:
-            err('password was not found in file ' + opts.password_file)
-        return password
+        return read_password_file(opts.password_file)
 
     # User did not specify a password, prompt twice to make sure that
     # the password is specified correctly.
@@ -718,6 +3138,69 @@ def get_password(opts):
     return password
 
 
+def read_password_file(path):
+    '''
+    Read the password from the first line of a file that is not blank
+    or starts with #.
+    '''
+    return read_passwords(path)[0]
+
+
+def read_passwords(path):
+    '''
+    Read all of the passwords in a file, one per line. Blank lines
+    and lines that start with # are skipped.
+    '''
+    if not os.path.exists(path):
+        err("password file doesn't exist: {}".format(path))
+    passwords = []
+    with open(path, 'rb') as ifp:
+        for line in ifp.readlines():
+            # leading and trailing white space not allowed
+            line = line.strip()
+            # skip empty and comment lines
+            if line and line[0:1] != b'#':
+                passwords.append(line)
+    if len(passwords) == 0:
+        err('password was not found in file ' + path)
+    return passwords
+
+
+def parse_size(text):
+    '''
+    Parse a size with an optional K, M, G or T suffix (powers of
+    1024). It is an argparse type.
+    '''
+    suffixes = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    scale = suffixes.get(text[-1:], 1)
+    if scale > 1:
+        text = text[:-1]
+    try:
+        size = int(float(text) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(text))
+    if size < 1:
+        raise argparse.ArgumentTypeError('size must be positive: {}'.format(text))
+    return size
+
+
+def parse_shard(text):
+    '''
+    Parse a shard specification, I/N where 1 <= I <= N.
+    It is an argparse type.
+
+    @returns the (I, N) tuple.
+    '''
+    try:
+        index, count = [int(x) for x in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid shard, expected I/N: {}'.format(text))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('invalid shard, I must be in the range [1..N]: {}'.format(text))
+    return index, count
+
+
 def getopts():
     '''
     Get the command line options.
@@ -788,6 +3271,14 @@ def getopts():
    $ openssl enc -aes-256-cbc -d -a -salt -pass file:pass.txt -in file.txt.locked
    $ {0} -p pass.txt -c -u file.txt.locked
 
+   # Example 8: change the password from pass.txt to newpass.txt
+   #            and convert the files to the binary format.
+   $ {0} -p pass.txt --rekey newpass.txt --rekey-kdf scrypt file.txt.locked
+
+   # Example 9: verify that locked files can be unlocked without
+   #            writing anything.
+   $ {0} -p pass.txt -r --verify project1 project2
+
 COPYRIGHT:
    Copyright (c) 2015 Joe Linoff, all rights reserved
 
@@ -805,6 +3296,19 @@ PROJECT:
 
     group1 = parser.add_mutually_exclusive_group()
 
+    parser.add_argument('--all-layers',
+                        action='store_true',
+                        help='''Unlock files that were locked more than once
+(file.txt.locked.locked) in a single pass.
+All of the layers are removed in memory and
+only the plaintext is written.
+
+If the password file has more than one
+password, they are used in order for each
+layer, outermost first. Otherwise the same
+password is used for every layer.
+ ''')
+
     parser.add_argument('-c', '--openssl',
                         action='store_true',
                         help='''Enable openssl compatibility.
@@ -828,6 +3332,22 @@ These two decrypt commands are equivalent.
                         help='''Unlock/decrypt files.
 This option is deprecated.
 It is the same as --unlock.
+ ''')
+
+    parser.add_argument('--dedup',
+                        action='store',
+                        type=str,
+                        metavar=('DIR'),
+                        help='''Store each unique content once in the content
+addressed store DIR when files are locked. The
+locked file of each path is a small reference
+to the content in the store. Identical files
+are only encrypted and stored once.
+
+Unlock and verify with the same DIR to resolve
+the references. The content stays in the store.
+DIR must not be inside a directory that is
+processed.
  ''')
 
     parser.add_argument('-e', '--encrypt',
@@ -835,6 +3355,28 @@ It is the same as --unlock.
                         help='''Lock/encrypt files.
 This option is deprecated.
 This is the same as --lock and is the default.
+ ''')
+
+    parser.add_argument('--events',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Append a JSON line to FILE for each file that
+is processed with the operation, the size,
+the time it took and whether it succeeded.
+ ''')
+
+    parser.add_argument('-H', '--hash',
+                        action='store',
+                        choices=['sha256', 'blake2b'],
+                        help='''Compute a hash of the content of each file
+while it is locked.
+
+In the binary format (--kdf), the hash is
+encrypted and stored in the locked file and it
+is checked whenever the file is unlocked or
+verified. For the other formats, use
+--manifest to store the hashes.
  ''')
 
     parser.add_argument('-i', '--inplace',
@@ -861,17 +3403,113 @@ behavior of the previous version.
 
 This can be helpful if there a lot of large
 files to process where large refers to files
-larger than a MB.
+larger than a MB. On network file systems like
+NFS or SMB use many more threads than cores,
+the threads mostly wait for the server.
 
 Default: %(default)s
  ''')
 
+    parser.add_argument('--journal',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Record the progress of the run in an
+append-only journal file.
+
+Completed files and in-flight temporary
+outputs are recorded. Outputs are written to
+a temporary file and renamed when they are
+complete so a run that is interrupted never
+leaves a partial output behind.
+
+The file must not exist unless --resume is
+specified.
+ ''')
+
+    parser.add_argument('-k', '--kdf',
+                        action='store',
+                        choices=['pbkdf2', 'scrypt'],
+                        help='''Lock files using a strong key derivation
+function (KDF) for the password.
+
+The files are written in a binary format
+that stores the KDF parameters in a header.
+The expensive KDF runs once per run to
+create a master key and the key for each file
+is derived from it using HKDF, so the cost per
+file is negligible. The format is detected
+automatically when files are unlocked so this
+option is not needed for --unlock.
+
+If it is specified with -c, pbkdf2 is
+compatible with openssl -pbkdf2 -iter COST.
+In that case the KDF runs for each file
+and it must be specified for --unlock.
+ ''')
+
+    parser.add_argument('-K', '--kdf-cost',
+                        action='store',
+                        type=int,
+                        metavar=('COST'),
+                        help='''The cost of the --kdf.
+For pbkdf2 it is the number of iterations,
+for scrypt it is log2 of the N parameter.
+
+Default: pbkdf2 {0}, scrypt {1},
+         pbkdf2 with -c {2}
+ '''.format(KDF_COSTS['pbkdf2'], KDF_COSTS['scrypt'], OPENSSL_PBKDF2_ITER))
+
     parser.add_argument('-l', '--lock',
                         action='store_true',
                         help='''Lock files.
 Files are locked and the ".locked" extension
 is appended unless the --suffix option is
 specified.
+ ''')
+
+    parser.add_argument('--manifest',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Store the --hash of the content of each file
+in FILE in the format of sha256sum or b2sum
+when the files are locked. The hashes are
+checked when the files are unlocked or
+verified with the same FILE. The paths are
+relative to the directory of FILE.
+ ''')
+
+    parser.add_argument('-m', '--max-memory',
+                        action='store',
+                        type=parse_size,
+                        metavar=('SIZE'),
+                        help='''The maximum number of bytes that the worker
+threads can hold in memory at the same time.
+
+Each file needs about {0} times its size when it
+is processed in memory. A worker waits until
+the memory is available before it reads a
+file. Files that need more than the maximum
+divided by --jobs are streamed in chunks.
+
+The size can have a K, M, G or T suffix.
+
+Default: half of the available memory
+ '''.format(MEMORY_FACTOR))
+
+    parser.add_argument('--metrics',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Write histograms of the time to process each
+file and of the throughput to FILE in the
+Prometheus text format when the run is done.
+They are split by operation and by file size.
+
+Use a FILE that ends with .prom in the
+directory of the node_exporter textfile
+collector.
  ''')
 
     parser.add_argument('-o', '--overwrite',
@@ -904,6 +3542,98 @@ the command history.
                         help='''Recurse into subdirectories.
  ''')
 
+    parser.add_argument('--rekey',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Change the password of locked files to the
+password in FILE.
+
+Each file is decrypted with the current
+password and encrypted with the new password
+in a single pass without writing the
+plaintext to disk. The new file replaces the
+old one when it is complete so the name does
+not change.
+
+The current format is specified as for
+--unlock.
+ ''')
+
+    parser.add_argument('--rekey-kdf',
+                        action='store',
+                        choices=['pbkdf2', 'scrypt'],
+                        metavar=('KDF'),
+                        help='''Convert the files to the binary format with
+this key derivation function while they are
+rekeyed. The --kdf-cost option applies to
+this KDF.
+
+Default: keep the current format
+ ''')
+
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='''Resume an interrupted run using the journal
+specified by --journal.
+
+Partial outputs are removed, files that were
+completed are skipped and the remaining files
+are processed. Use the same options and files
+as the interrupted run.
+ ''')
+
+    parser.add_argument('-S', '--schedule',
+                        action='store',
+                        choices=['name', 'size', 'auto'],
+                        default='name',
+                        help='''The order in which files are given to the
+--jobs worker threads.
+
+name: case-insensitive name order.
+size: largest files first so that a large file
+      does not start last while the other
+      workers are idle.
+auto: largest files first, then alternate
+      between small and large files to keep
+      both I/O and CPU busy.
+
+size and auto scan all of the files before
+starting so they use memory for the list.
+
+Default: %(default)s
+ ''')
+
+    parser.add_argument('--shard',
+                        action='store',
+                        type=parse_shard,
+                        metavar=('I/N'),
+                        help='''Only process shard I of N of the files.
+
+Each file belongs to exactly one shard based
+on a stable hash of its path relative to the
+directory on the command line so N runs with
+the same FILES and --shard 1/N to N/N process
+each file exactly once without any other
+coordination. They can run at the same time
+on different machines.
+ ''')
+
+    parser.add_argument('--shard-plan',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Balance the bytes in each shard instead of
+hashing the paths.
+
+The first shard to start assigns all of the
+files to the shards largest first and writes
+the assignment to FILE. The other shards read
+it. FILE must be on storage that all of the
+shards share and it must not exist before the
+first run of the shards.
+ ''')
+
     parser.add_argument('-s', '--suffix',
                         action='store',
                         type=str,
@@ -913,6 +3643,33 @@ the command history.
 Default: %(default)s
  ''')
 
+    parser.add_argument('--stats',
+                        action='store',
+                        type=str,
+                        metavar=('FILE'),
+                        help='''Write the summary statistics to FILE as JSON.
+
+The counters can be added up to merge the
+statistics of the shards of a run.
+ ''')
+
+    parser.add_argument('--stdout',
+                        action='store_true',
+                        help='''Write the locked or unlocked output to stdout.
+The input file is not removed. Exactly one
+file may be specified. If it is "-", the
+input is read from stdin so the tool can be
+used in a pipeline. The data is processed in
+chunks so the memory used does not depend on
+the size of the input.
+
+Messages are written to stderr in this mode.
+
+Example:
+   $ tar cf - dir | {0} -P PASSWORD --stdout - >dir.tar.locked
+   $ {0} -P PASSWORD -u --stdout - <dir.tar.locked | tar xf -
+ '''.format(base))
+
     parser.add_argument('-u', '--unlock',
                         action='store_true',
                         help='''Unlock files.
@@ -931,6 +3688,19 @@ A single -v generates a summary report.
 
 Two or more -v options show all of the files
 being processed.
+ ''')
+
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='''Verify that the locked files can be unlocked
+with the password without writing anything.
+
+Each file is decrypted in chunks and the
+plaintext is discarded. The path of each file
+that fails is reported and the exit status
+is 1 if any file failed.
+
+Use -v to report the files that passed.
  ''')
 
     # Display the version number and exit.
@@ -976,6 +3746,16 @@ so the program continues.
         opts.unlock = True
     if opts.encrypt is True:
         opts.lock = True
+    if opts.rekey_kdf and not opts.rekey:
+        err('--rekey-kdf requires --rekey.')
+    if opts.rekey and opts.verify is True:
+        err('--rekey cannot be used with --verify.')
+    if opts.all_layers is True and (opts.verify is True or opts.rekey):
+        err('--all-layers cannot be used with --verify or --rekey.')
+    if opts.verify is True or opts.rekey or opts.all_layers is True:
+        if opts.lock is True:
+            err('--verify, --rekey and --all-layers cannot be used with --lock.')
+        opts.unlock = True
     if opts.lock is True and opts.unlock is True:
         err('You have specified mutually exclusive options to lock/encrypt and unlock/decrypt.')
     if opts.lock is False and opts.unlock is False:
@@ -986,6 +3766,62 @@ so the program continues.
         opts.overwrite = True
     elif opts.overwrite == True and opts.suffix == '':
         opts.inplace = True
+    if opts.jobs < 1:
+        err('--jobs must be at least 1.')
+    opts.pool_buffers = opts.max_memory is None  # keep all of the buffers for reuse unless -m was given
+    if opts.max_memory is None:
+        opts.max_memory = get_available_memory() // 2
+    if opts.openssl is True and opts.kdf not in [None, 'pbkdf2']:
+        err('openssl compatibility (-c) only supports --kdf pbkdf2.')
+    if opts.kdf_cost is not None:
+        kdf = opts.rekey_kdf or opts.kdf
+        if kdf is None:
+            err('--kdf-cost requires --kdf.')
+        if kdf == 'pbkdf2' and not is_kdf_cost_valid(kdf, opts.kdf_cost):
+            err('--kdf-cost for pbkdf2 must be in the range [1..{}].'.format(KDF_MAX_PBKDF2_ITER))
+        if kdf == 'scrypt' and (opts.kdf_cost < 10 or not is_kdf_cost_valid(kdf, opts.kdf_cost)):
+            err('--kdf-cost for scrypt must be in the range [10..20], it needs 128 * 8 * 2^COST bytes.')
+    if '-' in opts.FILES:
+        opts.stdout = True
+    if opts.stdout is True and len(opts.FILES) != 1:
+        err('--stdout requires exactly one file or "-" for stdin.')
+    if opts.resume is True and not opts.journal:
+        err('--resume requires --journal.')
+    if opts.journal and opts.stdout is True:
+        err('--journal cannot be used with --stdout.')
+    if opts.verify is True and (opts.stdout is True or opts.journal):
+        err('--verify cannot be used with --stdout or --journal.')
+    if opts.rekey and opts.stdout is True:
+        err('--rekey cannot be used with --stdout.')
+    if opts.shard_plan and opts.shard is None:
+        err('--shard-plan requires --shard.')
+    if opts.manifest:
+        if opts.stdout is True or opts.rekey or opts.all_layers is True:
+            err('--manifest cannot be used with --stdout, --rekey or --all-layers.')
+        if opts.lock is True and opts.hash is None:
+            opts.hash = 'sha256'
+        if opts.lock is False and not os.path.exists(opts.manifest):
+            err('manifest does not exist: {}'.format(opts.manifest))
+    elif opts.hash and opts.lock is True and get_cipher(opts).m_binary is False:
+        err('--hash requires the binary format (--kdf) or --manifest.')
+    if opts.dedup:
+        if opts.stdout is True or opts.rekey or opts.all_layers is True or opts.manifest:
+            err('--dedup cannot be used with --stdout, --rekey, --all-layers or --manifest.')
+        store = os.path.abspath(opts.dedup)
+        for entry in opts.FILES:
+            if os.path.isdir(entry) and (store + os.sep).startswith(os.path.join(os.path.abspath(entry), '')):
+                err('the dedup store cannot be inside a directory that is processed: {}'.format(opts.dedup))
+    if (opts.metrics or opts.events) and opts.stdout is True:
+        err('--metrics and --events cannot be used with --stdout.')
+    if opts.shard is not None and opts.stdout is True:
+        err('--shard cannot be used with --stdout.')
+    if opts.all_layers is True and (opts.stdout is True or opts.suffix == ''):
+        err('--all-layers cannot be used with --stdout or --inplace.')
+    if opts.journal and opts.resume is False and os.path.exists(opts.journal):
+        err('journal exists, specify --resume to continue the previous run: {}'.format(opts.journal))
+    # The files that the program writes are never processed.
+    outputs = [opts.manifest, opts.metrics, opts.events, opts.stats, opts.shard_plan]
+    opts.outputs = set(os.path.abspath(path) for path in outputs if path)
     return opts
 
 
@@ -994,7 +3830,17 @@ def main():
     main
     '''
     opts = getopts()
+    if opts.stdout is True:
+        # Keep a private handle to stdout for the data and send
+        # everything else that writes to stdout to stderr instead.
+        sys.stdout.flush()
+        opts.stdout_fp = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
     password = get_password(opts)
+    if opts.rekey:
+        opts.rekey_password = read_password_file(opts.rekey)
+    if opts.all_layers is True:
+        opts.layer_passwords = read_passwords(opts.password_file) if opts.password_file else [password]
 
     stats = {
         'locked': 0,
@@ -1004,12 +3850,45 @@ def main():
         'dirs': 0,
         'read': 0,
         'written': 0,
+        'resumed': 0,
+        'streamed': 0,
+        'verified': 0,
+        'failed': 0,
+        'rekeyed': 0,
+        'layers': 0,
+        'deduped': 0,
+        'saved': 0,
         }
 
+    global th_budget
+    th_budget = MemoryBudget(opts.max_memory)
+    if opts.pool_buffers is False:
+        th_buffers.trim(2 * CHUNK_SIZE)  # keep the stream buffers only
+
+    global th_manifest
+    if opts.manifest:
+        th_manifest = Manifest(opts.manifest, opts.lock)
+        if opts.lock is False:
+            opts.hash = opts.hash or th_manifest.m_hash or 'sha256'
+
+    global th_dedup
+    if opts.dedup:
+        try:
+            th_dedup = DedupStore(opts.dedup, password, opts.lock)
+        except (IOError, OSError) as exc:
+            err('failed to open the dedup store "{}": {}'.format(opts.dedup, exc))
+
+    global th_metrics
+    if opts.metrics or opts.events:
+        th_metrics = Metrics(opts.events)
+
+    global th_journal
+    if opts.journal:
+        th_journal = Journal(opts.journal, opts.resume)
+        if th_journal.m_cleaned > 0:
+            infov(opts, 'removed {:,} partial outputs from the previous run'.format(th_journal.m_cleaned))
+
     # Use the mutex for I/O to avoid interspersed output.
-    # Use the semaphore to limit the number of active threads.
-    global th_semaphore
-    th_semaphore = Semaphore(opts.jobs)
 
     try:
         run(opts, password, stats)
@@ -1020,8 +3899,22 @@ def main():
         errn('^C detected, cleaning up threads, please wait\n')
         wait_for_threads()
 
+    if th_journal is not None:
+        th_journal.close()
     summary(opts, stats)
-    if th_abort == True:
+    if opts.stats:
+        write_stats(opts, stats)
+    if th_manifest is not None:
+        th_manifest.close()
+    if th_metrics is not None:
+        th_metrics.close()
+        if opts.metrics:
+            labels = {'shard': '{}/{}'.format(*opts.shard)} if opts.shard else None
+            try:
+                th_metrics.write_prometheus(opts.metrics, labels)
+            except (IOError, OSError) as exc:
+                errn('failed to write the metrics file "{}": {}'.format(opts.metrics, exc))
+    if th_abort == True or stats['failed'] > 0:
         sys.exit(1)
 
 
@@ -7,8 +7,8 @@
 #
 # If, like me, you use different versions of python, you
 # select them as follows:
-#    ./test.sh 'python2.7 ../lock_files.py'
 #    ./test.sh 'python3.6 ../lock_files.py'
+#    ./test.sh 'python3.7 ../lock_files.py'
 #
 # Note that file1.txt and file2.txt are copied to intermediate
 # files throughout the tests. This is so that test data is not
@@ -85,6 +85,12 @@ Failed=0
 Total=0
 Prog=${1:-"../lock_files.py"}
 info "Prog=$Prog"
+# The python interpreter for the python tests.
+Python=python
+if [[ "$Prog" == *' '* ]] ; then
+    Python=${Prog%% *}
+fi
+info "Python=$Python"
 rm -f test*.txt*
 
 # Test simple lock.
@@ -257,17 +263,84 @@ info 'test openssl encrypt, lock_files decrypt'
 tid=${LINENO}
 Runcmd rm -f test.txt test.txt.locked
 Runcmd cp file1.txt test.txt
-Test 'openssl-enc' openssl enc -aes-256-cbc -e -a -salt -pass pass:secret -in test.txt -out test.txt.locked
+Test 'openssl-enc' openssl enc -aes-256-cbc -e -a -salt -md md5 -pass pass:secret -in test.txt -out test.txt.locked
 Test 'unlock-run' $Prog -c -W -P secret -u test.txt.locked
-Test 'diff-test' diff file1.txt test1.txt
+Test 'diff-test' diff file1.txt test.txt
 
 info 'test lock_files encrypt, openssl decrypt'
 Runcmd rm -f test.txt test.txt.locked
 Runcmd cp file1.txt test.txt
 Test 'lock-run' $Prog -c -W -P secret -l test.txt
-Test 'openssl-dec' openssl enc -aes-256-cbc -d -a -salt -pass pass:secret -in test.txt.locked -out test.txt
+Test 'openssl-dec' openssl enc -aes-256-cbc -d -a -salt -md md5 -pass pass:secret -in test.txt.locked -out test.txt
+Test 'diff-test' diff file1.txt test1.txt
+
+# Test the strong KDF binary format.
+Runcmd cp file1.txt test1.txt
+Test 'kdf-pbkdf2-lock' $Prog -P secret -k pbkdf2 -K 1000 -l test1.txt
+Test 'kdf-wrong-password' '!' $Prog -P wrong -u test1.txt.locked
+Test 'kdf-pbkdf2-unlock' $Prog -P secret -u test1.txt.locked
+Test 'diff-test' diff file1.txt test1.txt
+Test 'kdf-scrypt-lock' $Prog -P secret -k scrypt -K 12 -l test1.txt
+Test 'kdf-scrypt-unlock' $Prog -P secret -u test1.txt.locked
+Test 'diff-test' diff file1.txt test1.txt
+Test 'kdf-pipe' "cat file2.txt | $Prog -P secret -k scrypt -K 12 --stdout - | $Prog -P secret -u --stdout - | diff file2.txt -"
+Test 'kdf-bad-cost' '!' $Prog -P secret -k scrypt -K 99 -l test1.txt
+Test 'kdf-scrypt-memory' '!' $Prog -P secret -k scrypt -K 21 -l test1.txt
+Test 'kdf-pbkdf2-limit' '!' $Prog -P secret -k pbkdf2 -K 10000001 -l test1.txt
+Test 'kdf-openssl-dec' "$Prog -c -P secret -k pbkdf2 --stdout - <file1.txt | openssl enc -aes-256-cbc -d -a -pbkdf2 -iter 10000 -pass pass:secret | diff file1.txt -"
+Test 'kdf-openssl-enc' "openssl enc -aes-256-cbc -e -a -pbkdf2 -iter 2000 -pass pass:secret -in file1.txt | $Prog -c -P secret -k pbkdf2 -K 2000 -u --stdout - | diff file1.txt -"
+
+# Test stdin/stdout pipe mode.
+Runcmd rm -f test.txt test.txt.locked
+Test 'pipe-lock' "$Prog -P secret --stdout - <file1.txt >test.txt.locked"
+Test 'pipe-unlock' "$Prog -P secret -u --stdout - <test.txt.locked >test.txt"
+Test 'diff-test' diff file1.txt test.txt
+Test 'pipe-roundtrip' "cat file2.txt | $Prog -P secret -w 0 --stdout - | $Prog -P secret -u --stdout - | diff file2.txt -"
+Test 'pipe-bad-password' "! $Prog -P wrong -u --stdout - <test.txt.locked >/dev/null"
+Test 'pipe-openssl-dec' "$Prog -c -P secret --stdout - <file1.txt | openssl enc -aes-256-cbc -d -a -salt -md md5 -pass pass:secret | diff file1.txt -"
+Test 'pipe-openssl-enc' "openssl enc -aes-256-cbc -e -a -salt -md md5 -pass pass:secret -in file1.txt | $Prog -c -P secret -u --stdout - | diff file1.txt -"
+Runcmd cp file1.txt test1.txt
+Test 'pipe-named-file' "$Prog -P secret --stdout test1.txt >test1.txt.locked"
+Test 'pipe-named-exists' '[' -e 'test1.txt' ']'
+Test 'unlock-run' $Prog -P secret -o -u test1.txt.locked
 Test 'diff-test' diff file1.txt test1.txt
 
+# Test the journal and resuming an interrupted run.
+Runcmd rm -rf tmp
+Runcmd mkdir tmp
+for(( i=1; i<=4; i++ )) ; do
+    Runcmd cp file1.txt tmp/test$i.txt
+done
+Test 'journal-lock' $Prog -P secret --journal tmp/journal.log tmp/test1.txt
+Test 'journal-exists' '[' -e 'tmp/journal.log' ']'
+Test 'journal-done' grep -q done tmp/journal.log
+Test 'journal-no-resume' '!' $Prog -P secret --journal tmp/journal.log tmp
+# Simulate a crash: test2 was renamed but the input was not removed,
+# test3 has a partial temporary output, test4 was renamed but the
+# journal ends right after its begin record with a torn write.
+Runcmd "$Prog -P secret --stdout tmp/test2.txt >tmp/test2.txt.locked"
+Runcmd "$Prog -P secret --stdout tmp/test4.txt >tmp/test4.txt.locked"
+Dir=$(cd tmp && pwd)
+echo "{\"op\": \"begin\", \"src\": \"$Dir/test2.txt\", \"tmp\": \"$Dir/.test2.txt.locked.lftmp\", \"out\": \"$Dir/test2.txt.locked\"}" >>tmp/journal.log
+echo "{\"op\": \"renamed\", \"src\": \"$Dir/test2.txt\"}" >>tmp/journal.log
+echo "{\"op\": \"begin\", \"src\": \"$Dir/test3.txt\", \"tmp\": \"$Dir/.test3.txt.locked.lftmp\", \"out\": \"$Dir/test3.txt.locked\"}" >>tmp/journal.log
+echo 'partial' >tmp/.test3.txt.locked.lftmp
+echo '{"op": "do' >>tmp/journal.log
+echo "{\"op\": \"begin\", \"src\": \"$Dir/test4.txt\", \"tmp\": \"$Dir/.test4.txt.locked.lftmp\", \"out\": \"$Dir/test4.txt.locked\", \"old\": null}" >>tmp/journal.log
+printf '{"op": "ren' >>tmp/journal.log
+Test 'journal-resume' $Prog -P secret -v --journal tmp/journal.log --resume tmp
+Test 'journal-resume-renamed' '[' '!' -e 'tmp/test4.txt' ']'
+Test 'journal-resume-torn' "grep -q '^{\"op\": \"done\", \"src\": \"$Dir/test4.txt\"' tmp/journal.log"
+Test 'journal-resume-partial' '[' '!' -e 'tmp/.test3.txt.locked.lftmp' ']'
+Test 'journal-resume-input' '[' '!' -e 'tmp/test2.txt' ']'
+Test 'journal-resume-skip' '[' '!' -e 'tmp/test1.txt.locked.locked' ']'
+Test 'journal-resume-skip' '[' '!' -e 'tmp/journal.log.locked' ']'
+Test 'unlock-run' $Prog -P secret -u tmp
+for(( i=1; i<=4; i++ )) ; do
+    Test 'diff-test' diff file1.txt tmp/test$i.txt
+done
+Runcmd rm -rf tmp
+
 # Test different lengths to verify padding.
 for(( i=1; i<=33; i++ )) ; do
     str=""
@@ -281,6 +354,316 @@ for(( i=1; i<=33; i++ )) ; do
     Test  "unlock-run-$i" $Prog -P secret -v -v --unlock -i test1.txt
 done
 
+# Test the size-aware schedules.
+for schedule in size auto ; do
+    Runcmd rm -rf tmp
+    Runcmd mkdir -p tmp/tmp
+    Runcmd cp file1.txt tmp/
+    Runcmd cp file2.txt tmp/tmp/
+    Runcmd "cat file1.txt file2.txt file1.txt >tmp/test3.txt"
+    Test "schedule-$schedule-lock" $Prog -P secret -r -j 2 -S $schedule -l tmp
+    Test 'schedule-lock-exists' '[' -e 'tmp/test3.txt.locked' ']'
+    Test 'schedule-lock-exists' '[' -e 'tmp/tmp/file2.txt.locked' ']'
+    Test "schedule-$schedule-unlock" $Prog -P secret -r -j 3 -S $schedule -u tmp
+    Test 'diff-test' diff file1.txt tmp/file1.txt
+    Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+done
+Runcmd rm -rf tmp
+
+# Test the memory budget: files larger than the budget are streamed.
+for fmt in '' '-c' '-k pbkdf2 -K 1000' ; do
+    Runcmd rm -rf tmp
+    Runcmd mkdir -p tmp/tmp
+    Runcmd cp file1.txt tmp/
+    Runcmd cp file2.txt tmp/tmp/
+    Test "max-memory-lock$fmt" $Prog -P secret $fmt -r -j 2 -m 1K -l tmp
+    Test 'max-memory-lock-exists' '[' -e 'tmp/file1.txt.locked' ']'
+    Test 'max-memory-lock-tmp' '[' ! -e 'tmp/.file1.txt.locked.lftmp' ']'
+    Test "max-memory-unlock$fmt" $Prog -P secret $fmt -r -m 1K -u tmp
+    Test 'diff-test' diff file1.txt tmp/file1.txt
+    Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+done
+Runcmd cp file1.txt tmp/
+Test 'max-memory-inplace-lock' $Prog -P secret -i -m 1K -l tmp/file1.txt
+Test 'max-memory-inplace-unlock' $Prog -P secret -i -m 1K -u tmp/file1.txt
+Test 'diff-test' diff file1.txt tmp/file1.txt
+Test 'max-memory-large' $Prog -P secret -m 1G -l tmp/file1.txt
+Test 'max-memory-large' $Prog -P secret -m 1G -u tmp/file1.txt.locked
+Test 'diff-test' diff file1.txt tmp/file1.txt
+Test 'max-memory-bad' '!' $Prog -P secret -m 1X -l tmp/file1.txt
+Runcmd rm -rf tmp
+
+# Test verify: nothing is written and failures set the exit status.
+for fmt in '' '-c' '-k pbkdf2 -K 1000' ; do
+    Runcmd rm -rf tmp
+    Runcmd mkdir -p tmp/tmp
+    Runcmd cp file1.txt tmp/
+    Runcmd cp file2.txt tmp/tmp/
+    Test "verify-lock$fmt" $Prog -P secret $fmt -r -l tmp
+    Test "verify-ok$fmt" $Prog -P secret $fmt -r -j 2 --verify tmp
+    Test 'verify-no-output' '[' ! -e 'tmp/file1.txt' ']'
+    Test 'verify-locked' '[' -e 'tmp/file1.txt.locked' ']'
+    Test "verify-bad-password$fmt" '!' $Prog -P wrong $fmt -r --verify tmp
+    Test 'verify-locked' '[' -e 'tmp/tmp/file2.txt.locked' ']'
+done
+Runcmd "head -c 100 tmp/file1.txt.locked >tmp/truncated.txt.locked"
+Test 'verify-truncated' '!' $Prog -P secret -k pbkdf2 -K 1000 --verify tmp/truncated.txt.locked
+Test 'verify-failed-path' "$Prog -P secret -k pbkdf2 -K 1000 -r --verify tmp | grep -q 'truncated.txt.locked: FAILED'"
+Test 'verify-unlock' $Prog -P secret -k pbkdf2 -K 1000 -u tmp/file1.txt.locked
+Test 'diff-test' diff file1.txt tmp/file1.txt
+Test 'verify-lock-conflict' '!' $Prog -P secret -l --verify tmp
+Runcmd rm -rf tmp
+
+# Test rekey: the password changes in place and the format can be converted.
+Runcmd "echo new-secret >newpass.txt"
+for fmt in '' '-c' '-k pbkdf2 -K 1000' '-k scrypt -K 10' ; do
+    Runcmd rm -rf tmp
+    Runcmd mkdir -p tmp/tmp
+    Runcmd cp file1.txt tmp/
+    Runcmd cp file2.txt tmp/tmp/
+    Test "rekey-lock$fmt" $Prog -P secret $fmt -r -l tmp
+    Test "rekey$fmt" $Prog -P secret $fmt -r -j 2 --rekey newpass.txt tmp
+    Test 'rekey-exists' '[' -e 'tmp/tmp/file2.txt.locked' ']'
+    Test 'rekey-no-plaintext' '[' ! -e 'tmp/tmp/file2.txt' ']'
+    Test "rekey-old-password$fmt" '!' $Prog -P secret $fmt -r --verify tmp
+    Test "rekey-unlock$fmt" $Prog -p newpass.txt $fmt -r -u tmp
+    Test 'diff-test' diff file1.txt tmp/file1.txt
+    Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+done
+for fmt in '' '-c' ; do
+    Runcmd rm -rf tmp
+    Runcmd mkdir tmp
+    Runcmd cp file1.txt tmp/
+    Test "rekey-convert-lock$fmt" $Prog -P secret $fmt -l tmp
+    Test "rekey-convert$fmt" $Prog -P secret $fmt --rekey newpass.txt --rekey-kdf pbkdf2 -K 1000 tmp
+    Test 'rekey-convert-binary' "head -c 4 tmp/file1.txt.locked | grep -q LCK"
+    Test "rekey-convert-unlock$fmt" $Prog -p newpass.txt -u tmp/file1.txt.locked
+    Test 'diff-test' diff file1.txt tmp/file1.txt
+done
+Test 'rekey-lock' $Prog -P secret -k pbkdf2 -K 1000 -l tmp/file1.txt
+Test 'rekey-wrong-password' '!' $Prog -P wrong --rekey newpass.txt tmp/file1.txt.locked
+Test 'rekey-unchanged' $Prog -P secret --verify tmp/file1.txt.locked
+Test 'rekey-no-tmp' '[' ! -e 'tmp/.file1.txt.locked.lftmp' ']'
+Test 'rekey-kdf-requires-rekey' '!' $Prog -P secret --rekey-kdf scrypt -u tmp
+Runcmd rm -rf tmp newpass.txt
+
+# Test unlocking all of the layers of a file that was locked more than once.
+Runcmd rm -rf tmp
+Runcmd mkdir -p tmp/tmp
+Runcmd cp file1.txt tmp/
+Runcmd cp file2.txt tmp/tmp/
+Test 'all-layers-lock1' $Prog -P secret -r -l tmp
+Test 'all-layers-lock2' $Prog -P secret -k pbkdf2 -K 1000 -r -l tmp
+Test 'all-layers-lock3' $Prog -P secret -r -l tmp/file1.txt.locked.locked
+Test 'all-layers-unlock' $Prog -P secret -r -j 2 --all-layers -u tmp
+Test 'all-layers-no-locked' '[' ! -e 'tmp/file1.txt.locked' ']'
+Test 'diff-test' diff file1.txt tmp/file1.txt
+Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+Runcmd "printf '# outermost first\nsecret2\nsecret1\n' >layers.txt"
+Test 'all-layers-lock1' $Prog -P secret1 -l tmp/file1.txt
+Test 'all-layers-lock2' $Prog -P secret2 -l tmp/file1.txt.locked
+Test 'all-layers-wrong-order' '!' $Prog -P secret1 --all-layers -u tmp/file1.txt.locked.locked
+Test 'all-layers-unchanged' '[' -e 'tmp/file1.txt.locked.locked' ']'
+Test 'all-layers-passwords' $Prog -p layers.txt --all-layers -u tmp/file1.txt.locked.locked
+Test 'diff-test' diff file1.txt tmp/file1.txt
+Test 'all-layers-inplace' '!' $Prog -P secret -i --all-layers -u tmp
+Runcmd rm -rf tmp layers.txt
+
+# Test sharding: the shards process every file exactly once.
+for balance in '' '--shard-plan tmp-plan.json' ; do
+    Runcmd rm -rf tmp
+    Runcmd mkdir -p tmp/tmp
+    for(( i=1; i<=20; i++ )) ; do
+        Runcmd cp file1.txt tmp/test$i.txt
+    done
+    Runcmd cp file2.txt tmp/tmp/
+    Runcmd "cat file1.txt file2.txt >tmp/tmp/test3.txt"
+    for shard in 1/3 2/3 3/3 ; do
+        Test "shard-lock-$shard" $Prog -P secret -r --shard $shard $balance --stats tmp-stats-${shard/\//-}.json -l tmp
+    done
+    Test 'shard-all-locked' "[ \$(find tmp -type f ! -name '*.locked' | wc -l) -eq 0 ]"
+    Test 'shard-once' "[ \$(find tmp -type f -name '*.locked.locked' | wc -l) -eq 0 ]"
+    Test 'shard-stats' "cat tmp-stats-*.json | grep -h '\"locked\"' | awk '{s += \$2} END {exit s != 22}'"
+    for shard in 3/3 1/3 2/3 ; do
+        Test "shard-unlock-$shard" $Prog -P secret -r --shard $shard $balance -u tmp
+    done
+    Test 'diff-test' diff file1.txt tmp/test20.txt
+    Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+    Runcmd rm -f tmp-stats-*.json tmp-plan.json
+done
+Test 'shard-bad' '!' $Prog -P secret --shard 4/3 -l tmp
+Test 'shard-plan-requires-shard' '!' $Prog -P secret --shard-plan tmp-plan.json -l tmp
+Runcmd rm -rf tmp
+
+# Test the content hash that is stored in the binary format.
+for hash in sha256 blake2b ; do
+    for mem in '' '-m 1K' ; do
+        Runcmd rm -rf tmp
+        Runcmd mkdir tmp
+        Runcmd cp file1.txt file2.txt tmp/
+        Runcmd "cat file1.txt file2.txt file1.txt >tmp/test3.txt"
+        Runcmd "touch tmp/empty.txt"
+        Test "hash-lock-$hash$mem" $Prog -P secret -k pbkdf2 -K 1000 -H $hash $mem -l tmp
+        Test "hash-verify-$hash$mem" $Prog -P secret $mem --verify tmp
+        Runcmd cp tmp/test3.txt.locked tmp/corrupt.txt.locked
+        Test 'hash-corrupt' "$Python -c \"import sys; d = bytearray(open(sys.argv[1], 'rb').read()); d[100] ^= 1; open(sys.argv[1], 'wb').write(d)\" tmp/corrupt.txt.locked"
+        Test "hash-corrupt-verify$mem" '!' $Prog -P secret $mem --verify tmp/corrupt.txt.locked
+        Test "hash-corrupt-unlock$mem" '!' $Prog -P secret $mem -u tmp/corrupt.txt.locked
+        Test 'hash-corrupt-no-output' '[' ! -e 'tmp/corrupt.txt' ']'
+        Runcmd rm -f tmp/corrupt.txt.locked
+        Test "hash-unlock-$hash$mem" $Prog -P secret $mem -u tmp
+        Test 'diff-test' diff file1.txt tmp/file1.txt
+        Test 'diff-test' diff file2.txt tmp/file2.txt
+        Test 'hash-empty' '[' ! -s 'tmp/empty.txt' ']'
+    done
+done
+Runcmd "echo new-secret >newpass.txt"
+Test 'hash-rekey-lock' $Prog -P secret -k pbkdf2 -K 1000 -H sha256 -l tmp/file1.txt
+Test 'hash-rekey' $Prog -P secret --rekey newpass.txt tmp/file1.txt.locked
+Test 'hash-rekey-kept' "$Python -c \"import sys; sys.exit(open(sys.argv[1], 'rb').read()[12] != 1)\" tmp/file1.txt.locked"
+Test 'hash-rekey-unlock' $Prog -p newpass.txt -u tmp/file1.txt.locked
+Test 'diff-test' diff file1.txt tmp/file1.txt
+Test 'hash-requires-binary' '!' $Prog -P secret -H sha256 -l tmp/file1.txt
+Runcmd rm -rf tmp newpass.txt
+
+# Test the content hash manifest for the formats that cannot store it.
+for fmt in '' '-c' ; do
+    Runcmd rm -rf tmp tmp.sha256
+    Runcmd mkdir tmp
+    Runcmd cp file1.txt file2.txt tmp/
+    Test "manifest-lock$fmt" $Prog -P secret $fmt --manifest tmp.sha256 -l tmp
+    Test 'manifest-lines' "[ \$(wc -l <tmp.sha256) -eq 2 ]"
+    Test "manifest-verify$fmt" $Prog -P secret $fmt --manifest tmp.sha256 --verify tmp
+    Test "manifest-unlock$fmt" $Prog -P secret $fmt -m 1K --manifest tmp.sha256 -u tmp/file1.txt.locked
+    Test "manifest-unlock$fmt" $Prog -P secret $fmt --manifest tmp.sha256 -u tmp/file2.txt.locked
+    Test 'manifest-sha256sum' sha256sum --quiet -c tmp.sha256
+    Test "manifest-relock$fmt" $Prog -P secret $fmt -l tmp/file1.txt
+    Runcmd "sed -i 's/^[0-9a-f]*/$(printf '0%.0s' {1..64})/' tmp.sha256"
+    Test "manifest-mismatch$fmt" '!' $Prog -P secret $fmt --manifest tmp.sha256 -u tmp/file1.txt.locked
+    Test 'manifest-no-output' '[' ! -e 'tmp/file1.txt' ']'
+done
+# A streamed file whose output cannot be renamed is not in the manifest.
+Runcmd rm -rf tmp tmp.sha256
+Runcmd mkdir -p tmp/file1.txt.locked
+Runcmd cp file1.txt file2.txt tmp/
+Test 'manifest-stream-fail' $Prog -P secret -W -m 1K --manifest tmp.sha256 -l tmp/file1.txt tmp/file2.txt
+Test 'manifest-stream-lines' "[ \$(wc -l <tmp.sha256) -eq 1 ]"
+Test 'manifest-stream-locked' grep -q file2.txt tmp.sha256
+Runcmd rm -rf tmp tmp.sha256
+# The paths are relative to the manifest and escaped like sha256sum.
+# The manifest is not locked when its directory is scanned.
+NlName=$'tmp/a\nb'
+Runcmd mkdir tmp
+Runcmd cp file1.txt file2.txt tmp/
+Runcmd 'cp file1.txt "$NlName"'
+Runcmd "cp file2.txt 'tmp/c\\d'"
+Test 'manifest-escape-lock' $Prog -P secret -c --manifest tmp/tmp.sha256 -l tmp
+Test 'manifest-escape-unlocked' '[' -e tmp/tmp.sha256 ']'
+Test 'manifest-escape-lines' "[ \$(wc -l <tmp/tmp.sha256) -eq 4 ]"
+Test 'manifest-escape-newline' "grep -qx '\\\\[0-9a-f]*  a\\\\nb' tmp/tmp.sha256"
+Test 'manifest-escape-normalized' "grep -qx '[0-9a-f]*  file1.txt' tmp/tmp.sha256"
+Test 'manifest-escape-unlock' $Prog -P secret -c --manifest tmp/tmp.sha256 -u ./tmp/file1.txt.locked
+Test 'manifest-escape-unlock' $Prog -P secret -c --manifest tmp/tmp.sha256 -u tmp
+Test 'manifest-escape-sha256sum' "(cd tmp && sha256sum --quiet -c tmp.sha256)"
+Runcmd $Prog -P secret -c --stats tmp/stats.json -l tmp/file1.txt
+Test 'manifest-escape-stats' $Prog -P secret -c --stats tmp/stats.json -l tmp
+Test 'manifest-escape-stats-unlocked' '[' -e tmp/stats.json -a ! -e tmp/stats.json.locked ']'
+Runcmd rm -rf tmp
+
+# Test the latency histograms and the event log.
+Runcmd rm -rf tmp tmp.prom tmp-events.jsonl
+Runcmd mkdir -p tmp/tmp
+Runcmd cp file1.txt tmp/
+Runcmd cp file2.txt tmp/tmp/
+Test 'metrics-lock' $Prog -P secret -k pbkdf2 -K 1000 -r -j 2 --metrics tmp.prom --events tmp-events.jsonl -l tmp
+Test 'metrics-count' "grep -q 'lock_files_file_duration_seconds_count{op=\"lock\",size_class=\"0-64K\"} 2' tmp.prom"
+Test 'metrics-inf' "grep -q 'lock_files_file_throughput_bytes_per_second_bucket{op=\"lock\",size_class=\"0-64K\",le=\"+Inf\"} 2' tmp.prom"
+Test 'metrics-events' "[ \$(grep -c '\"op\": \"lock\"' tmp-events.jsonl) -eq 2 ]"
+Test 'metrics-verify' '!' $Prog -P wrong -r --metrics tmp.prom --events tmp-events.jsonl --verify tmp
+Test 'metrics-failed' "grep -q 'lock_files_files_failed_total{op=\"verify\",size_class=\"0-64K\"} 2' tmp.prom"
+Test 'metrics-events-failed' "[ \$(grep -c '\"ok\": false' tmp-events.jsonl) -eq 2 ]"
+Test 'metrics-unlock' $Prog -P secret -r -u tmp
+Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+Runcmd rm -rf tmp tmp.prom tmp-events.jsonl
+
+# Test the batches of small files and the exclusive create of the outputs.
+Runcmd rm -rf tmp tmp-stats.json
+Runcmd mkdir tmp
+for(( i=1; i<=150; i++ )) ; do
+    Runcmd cp file1.txt tmp/test$i.txt
+done
+Runcmd "head -c 100000 /dev/urandom >tmp/big.bin"
+Runcmd cp tmp/big.bin big.bin
+Test 'batch-lock' $Prog -P secret -j 3 --stats tmp-stats.json -l tmp
+Test 'batch-stats' "grep -q '\"locked\": 151' tmp-stats.json"
+Test 'batch-all-locked' "[ \$(find tmp -type f ! -name '*.locked' | wc -l) -eq 0 ]"
+Test 'batch-unlock' $Prog -P secret -j 3 --stats tmp-stats.json -u tmp
+Test 'batch-unlock-stats' "grep -q '\"unlocked\": 151' tmp-stats.json"
+Test 'diff-test' diff file1.txt tmp/test150.txt
+Test 'diff-test' cmp big.bin tmp/big.bin
+Runcmd "echo keep >tmp/test1.txt.locked"
+Test 'exclusive-lock' '!' $Prog -P secret -l tmp/test1.txt
+Test 'exclusive-input' diff file1.txt tmp/test1.txt
+Test 'exclusive-output' grep -q keep tmp/test1.txt.locked
+Runcmd "echo keep >tmp/big.bin.locked"
+Test 'exclusive-warn' $Prog -P secret -W -m 100K -l tmp/test1.txt tmp/test150.txt tmp/big.bin
+Test 'exclusive-warn-input' '!' '[' -e 'tmp/test1.txt' ']'
+Test 'exclusive-warn-stream-input' '!' '[' -e 'tmp/big.bin' ']'
+Test 'exclusive-warn-others' '[' -e 'tmp/test150.txt.locked' ']'
+Test 'exclusive-warn-unlock' $Prog -P secret -u tmp/test1.txt.locked tmp/big.bin.locked
+Test 'diff-test' diff file1.txt tmp/test1.txt
+Test 'diff-test' cmp big.bin tmp/big.bin
+Runcmd rm -rf tmp tmp-stats.json big.bin
+
+# Test the content addressed store for identical files.
+Runcmd rm -rf tmp tmp-store tmp-stats.json
+Runcmd mkdir -p tmp/tmp
+Runcmd cp file1.txt tmp/test1.txt
+Runcmd cp file1.txt tmp/test2.txt
+Runcmd cp file1.txt tmp/tmp/test3.txt
+Runcmd cp file2.txt tmp/tmp/
+Test 'dedup-lock' $Prog -P secret -r -j 2 --dedup tmp-store --stats tmp-stats.json -l tmp
+Test 'dedup-stats' "grep -q '\"deduped\": 2' tmp-stats.json"
+Test 'dedup-saved' "grep -q \"\\\"saved\\\": \$(( 2 * \$(wc -c <file1.txt) ))\" tmp-stats.json"
+Test 'dedup-objects' "[ \$(find tmp-store -type f ! -name salt | wc -l) -eq 2 ]"
+Test 'dedup-reference' grep -q "'^#lock_files dedup '" tmp/test1.txt.locked
+Test 'dedup-inside' '!' $Prog -P secret -r --dedup tmp/store -l tmp
+Test 'dedup-verify' $Prog -P secret -r --dedup tmp-store --verify tmp
+Test 'dedup-unlock-wrong-password' '!' $Prog -P wrong -r --dedup tmp-store -u tmp
+Test 'dedup-unlock' $Prog -P secret -r --dedup tmp-store -u tmp
+Test 'diff-test' diff file1.txt tmp/test2.txt
+Test 'diff-test' diff file1.txt tmp/tmp/test3.txt
+Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+Test 'dedup-relock' $Prog -P secret -r --dedup tmp-store --stats tmp-stats.json -l tmp
+Test 'dedup-relock-stats' "grep -q '\"deduped\": 4' tmp-stats.json"
+Runcmd "cp \$(ls tmp-store/*/* | head -1) \$(ls tmp-store/*/* | tail -1)"
+Test 'dedup-tampered' '!' $Prog -P secret -r --dedup tmp-store --verify tmp
+Runcmd rm -rf tmp tmp-store tmp-stats.json
+
+# Test many more worker threads than files in a batch.
+Runcmd rm -rf tmp tmp-stats.json
+Runcmd mkdir -p tmp/tmp
+for(( i=1; i<=30; i++ )) ; do
+    Runcmd cp file1.txt tmp/test$i.txt
+done
+Runcmd cp file2.txt tmp/tmp/
+Runcmd "head -c 300000 /dev/urandom >tmp/big.bin"
+Runcmd cp tmp/big.bin big.bin
+Test 'many-jobs-lock' $Prog -P secret -r -k pbkdf2 -K 1000 -j 64 -m 2M --stats tmp-stats.json -l tmp
+Test 'many-jobs-stats' "grep -q '\"locked\": 32' tmp-stats.json"
+Test 'many-jobs-all-locked' "[ \$(find tmp -type f ! -name '*.locked' | wc -l) -eq 0 ]"
+Test 'many-jobs-unlock' $Prog -P secret -r -j 64 -u tmp
+Test 'diff-test' diff file1.txt tmp/test30.txt
+Test 'diff-test' diff file2.txt tmp/tmp/file2.txt
+Test 'diff-test' cmp big.bin tmp/big.bin
+Runcmd rm -rf tmp tmp-stats.json big.bin
+
+# Test that the cipher hot path does not allocate in proportion to the data.
+Test 'alloc-test' $Python test_alloc.py
+
+# Test the cipher, the padding, the wrapping and the traversal directly.
+Test 'unit-test' $Python test_lock_files.py
+
 # Test different processing of 200 files to analyze thread performance.
 info 'setup for jobs test'
 Runcmd rm -rf tmp
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+'''
+Verify that the cipher hot path does not allocate memory in
+proportion to the size of the data.
+
+Run it from the test directory:
+   $ python3 test_alloc.py
+'''
+import os
+import sys
+import tracemalloc
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lock_files  # noqa: E402
+
+
+class TestAllocations(unittest.TestCase):
+    '''
+    Measure the peak traced memory of the encrypt and decrypt paths.
+    '''
+    def peak(self, fct):
+        '''
+        Run the function and return the peak traced memory.
+        '''
+        tracemalloc.start()
+        try:
+            fct()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def base64_peak(self, size):
+        '''
+        The peak memory of base64 encoding size bytes which is the
+        one allocation that the encrypt paths cannot avoid.
+        '''
+        data = os.urandom(size)
+        return self.peak(lambda: lock_files.base64.b64encode(data))
+
+    def test_stream_encrypt(self):
+        '''
+        The peak memory of the streaming encryptor does not depend on
+        the number of chunks.
+        '''
+        cipher = lock_files.AESCipher()
+        chunk = os.urandom(lock_files.CHUNK_SIZE)
+
+        def encrypt(num):
+            stream = lock_files.AESStreamEncryptor(cipher, 'secret')
+            for _ in range(num):
+                stream.update(chunk)
+            stream.finalize()
+            stream.close()
+
+        encrypt(1)  # warm up the pool
+        small = self.peak(lambda: encrypt(4))
+        large = self.peak(lambda: encrypt(64))
+        self.assertLess(large, self.base64_peak(lock_files.CHUNK_SIZE) + 64 * 1024)
+        self.assertLess(large, small + 64 * 1024)
+
+    def test_stream_decrypt(self):
+        '''
+        The peak memory of the streaming decryptor does not depend on
+        the number of chunks.
+        '''
+        cipher = lock_files.AESCipher()
+        text = cipher.encrypt('secret', os.urandom(lock_files.CHUNK_SIZE * 3))
+        chunks = [text[i:i+lock_files.CHUNK_SIZE] for i in range(0, len(text), lock_files.CHUNK_SIZE)]
+
+        def decrypt(num):
+            for _ in range(num):
+                stream = lock_files.AESStreamDecryptor(cipher, 'secret')
+                for chunk in chunks:
+                    stream.update(chunk)
+                stream.finalize()
+                stream.close()
+
+        decrypt(1)  # warm up the pool
+        small = self.peak(lambda: decrypt(1))
+        large = self.peak(lambda: decrypt(16))
+        self.assertLess(large, 4 * lock_files.CHUNK_SIZE)
+        self.assertLess(large, small + 64 * 1024)
+
+    def test_encrypt(self):
+        '''
+        Encrypting in memory only allocates the base64 output once the
+        pool is warm.
+        '''
+        cipher = lock_files.AESCipher()
+        plaintext = os.urandom(8 * 1024 * 1024)
+        cipher.encrypt('secret', plaintext)  # warm up the pool
+        peak = self.peak(lambda: cipher.encrypt('secret', plaintext))
+        self.assertLess(peak, self.base64_peak(len(plaintext)) + 64 * 1024)
+
+    def test_decrypt(self):
+        '''
+        Decrypting in memory only allocates the decoded input and the
+        plaintext.
+        '''
+        cipher = lock_files.AESCipher()
+        plaintext = os.urandom(8 * 1024 * 1024)
+        ciphertext = cipher.encrypt('secret', plaintext)
+        peak = self.peak(lambda: cipher.decrypt('secret', ciphertext))
+        self.assertLess(peak, 2.1 * len(plaintext))
+        self.assertEqual(cipher.decrypt('secret', ciphertext), plaintext)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,786 @@
+#!/usr/bin/env python
+'''
+Unit and property tests for the cipher, the padding, the output
+wrapping and the traversal functions, and an optional performance
+tier that compares the throughput and the peak memory with a stored
+baseline.
+
+Run it from the test directory:
+   $ python3 test_lock_files.py
+
+The property tests use random inputs. The seed is printed when a
+test fails; set LOCK_FILES_SEED to repeat a run.
+
+The performance tier only runs if LOCK_FILES_PERF is set:
+   $ LOCK_FILES_PERF=1 python3 test_lock_files.py TestPerf
+   $ LOCK_FILES_PERF=record python3 test_lock_files.py TestPerf
+
+The first compares with perf_baseline.json and fails if the
+throughput or the peak memory regressed by more than the tolerance
+stored in the baseline, the second records a new baseline for this
+machine.
+'''
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lock_files  # noqa: E402
+
+SEED = int(os.environ.get('LOCK_FILES_SEED', random.randrange(1 << 32)))
+PERF = os.environ.get('LOCK_FILES_PERF', '')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baseline.json')
+
+# The file sizes around the block, base64 and chunk boundaries.
+EDGE_SIZES = [0, 1, 2, 3, 15, 16, 17, 31, 32, 33, 47, 48, 49,
+              lock_files.CHUNK_SIZE - 1, lock_files.CHUNK_SIZE, lock_files.CHUNK_SIZE + 1]
+
+# The formats as constructor arguments with cheap KDF costs.
+FORMATS = [
+    {},
+    {'openssl': True},
+    {'openssl': True, 'kdf': 'pbkdf2', 'cost': 1000},
+    {'kdf': 'pbkdf2', 'cost': 1000},
+    {'kdf': 'scrypt', 'cost': 10},
+    {'kdf': 'pbkdf2', 'cost': 1000, 'hash': 'sha256'},
+    {'kdf': 'pbkdf2', 'cost': 1000, 'hash': 'blake2b'},
+]
+
+
+def get_opts(*args):
+    '''
+    Parse the command line options like the program does.
+    '''
+    argv = sys.argv
+    sys.argv = ['lock_files.py', '-P', 'secret'] + list(args)
+    try:
+        return lock_files.getopts()
+    finally:
+        sys.argv = argv
+
+
+def get_sizes(rng, num, limit):
+    '''
+    Get the edge sizes up to the limit and random sizes.
+    '''
+    return [size for size in EDGE_SIZES if size <= limit] + [rng.randrange(limit) for _ in range(num)]
+
+
+def stream(target, data, rng):
+    '''
+    Run the data through a stream encryptor or decryptor in chunks of
+    random sizes.
+    '''
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        num = rng.randrange(1, 2 * lock_files.CHUNK_SIZE)
+        out += target.update(data[i:i+num])
+        i += num
+    out += target.finalize()
+    target.close()
+    return bytes(out)
+
+
+class PropertyTestCase(unittest.TestCase):
+    '''
+    Test case with a random number generator that is seeded for each
+    test and a message that reports the seed.
+    '''
+    def setUp(self):
+        '''
+        Seed the random number generator.
+        '''
+        self.rng = random.Random('{}:{}'.format(SEED, self.id()))
+        self.msg = 'LOCK_FILES_SEED={}'.format(SEED)
+
+
+class TestPadding(PropertyTestCase):
+    '''
+    Test the PKCS#7 padding.
+    '''
+    def test_round_trip(self):
+        '''
+        Padding always adds 1 to size bytes to reach a multiple of the
+        size and unpadding removes them.
+        '''
+        cipher = lock_files.AESCipher()
+        for size in [8, 16, 32]:
+            for num in list(range(3 * size)) + [self.rng.randrange(4096) for _ in range(20)]:
+                text = os.urandom(num)
+                padded = cipher._pkcs7_pad(text, size)
+                self.assertEqual(len(padded) % size, 0, self.msg)
+                self.assertTrue(1 <= len(padded) - len(text) <= size, self.msg)
+                self.assertEqual(bytes(padded[:num]), text, self.msg)
+                self.assertEqual(bytes(cipher._pkcs7_unpad(bytes(padded), size)), text, self.msg)
+
+    def test_pad_value(self):
+        '''
+        Every padding byte is the number of padding bytes.
+        '''
+        cipher = lock_files.AESCipher()
+        for num in range(16):
+            padded = cipher._pkcs7_pad(b'x' * num, 16)
+            self.assertEqual(bytes(padded[num:]), bytes([16 - num]) * (16 - num))
+
+    def test_str(self):
+        '''
+        Text is padded with characters.
+        '''
+        cipher = lock_files.AESCipher()
+        self.assertEqual(cipher._pkcs7_pad('abc', 4), 'abc\x01')
+        self.assertEqual(cipher._pkcs7_unpad('abc\x01'), 'abc')
+
+    def test_bad_padding(self):
+        '''
+        Unpadding rejects a value that is out of range or padding
+        bytes that do not all have the same value.
+        '''
+        cipher = lock_files.AESCipher()
+        for padded in [b'', b'x' * 15 + b'\x00', b'x' * 15 + b'\x11', b'\x03', b'x' * 14 + b'\x01\x02']:
+            with self.assertRaises(ValueError):
+                cipher._pkcs7_unpad(padded)
+        padded = bytearray(b'abc\x02\x02')
+        self.assertIs(cipher._pkcs7_unpad(padded), padded)
+        self.assertEqual(padded, b'abc')
+
+
+class TestBufferPool(unittest.TestCase):
+    '''
+    Test the reuse of the cipher buffers.
+    '''
+    def test_trim(self):
+        '''
+        A trimmed pool does not keep the large buffers.
+        '''
+        pool = lock_files.BufferPool(max_size=1024)
+        small = pool.acquire(100)
+        large = pool.acquire(1000)
+        pool.release(small)
+        pool.release(large)
+        self.assertIs(pool.acquire(1000), large)
+        pool.release(large)
+        pool.trim(512)
+        self.assertIsNot(pool.acquire(1000), large)
+        self.assertIs(pool.acquire(100), small)
+        pool.release(large)
+        self.assertIsNot(pool.acquire(1000), large)
+
+
+class TestMasterKeys(unittest.TestCase):
+    '''
+    Test the cache of the master keys.
+    '''
+    def test_concurrent(self):
+        '''
+        The keys of different salts are derived at the same time and
+        each key is derived once.
+        '''
+        keys = lock_files.MasterKeys()
+        released = threading.Event()
+        derived = []
+        real = lock_files.PBKDF2HMAC
+
+        class BlockingKDF:
+            def __init__(self, **kwargs):
+                self.kdf = real(**kwargs)
+                self.blocked = None
+
+            def derive(self, password):
+                derived.append(self)
+                if password == b'first':
+                    self.blocked = released.wait(10)  # until the second key is derived
+                return self.kdf.derive(password)
+
+        results = {}
+
+        def get(password, salt):
+            results[password] = keys.get(password, 'pbkdf2', 1000, 0, 0, salt)
+        with unittest.mock.patch.object(lock_files, 'PBKDF2HMAC', BlockingKDF):
+            first = threading.Thread(target=get, args=(b'first', b'a' * 16))
+            first.start()
+            while not derived:
+                time.sleep(0.01)
+            get(b'second', b'b' * 16)
+            released.set()
+            first.join()
+            threads = [threading.Thread(target=get, args=(b'second', b'b' * 16)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertTrue(derived[0].blocked)
+        self.assertEqual(len(derived), 2)
+        self.assertNotEqual(results[b'first'], results[b'second'])
+
+
+class TestJournal(unittest.TestCase):
+    '''
+    Test the tracking of the completed files.
+    '''
+    def setUp(self):
+        '''
+        Create a temporary directory.
+        '''
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'journal')
+
+    def tearDown(self):
+        '''
+        Remove the temporary directory.
+        '''
+        shutil.rmtree(self.tmpdir)
+
+    def test_fresh(self):
+        '''
+        A fresh run does not keep the completed files in memory.
+        '''
+        journal = lock_files.Journal(self.path)
+        journal.done('a', 'a.locked')
+        journal.close()
+        self.assertFalse(journal.is_done('a.locked'))
+        self.assertEqual(len(journal.m_done), 0)
+
+    def test_resume(self):
+        '''
+        A resumed run skips the files completed by the previous runs.
+        '''
+        journal = lock_files.Journal(self.path)
+        journal.done('a', 'a.locked')
+        journal.close()
+        journal = lock_files.Journal(self.path, resume=True)
+        journal.done('b', 'b.locked')
+        journal.close()
+        self.assertTrue(journal.is_done('a.locked'))
+        self.assertTrue(journal.is_done('b.locked'))
+        self.assertFalse(journal.is_done('c.locked'))
+
+
+class TestAESCipher(PropertyTestCase):
+    '''
+    Test the encryption and decryption of every format.
+    '''
+    def test_round_trip(self):
+        '''
+        Decrypting the encrypted data returns the data for every size
+        and format.
+        '''
+        for kwargs in FORMATS:
+            cipher = lock_files.AESCipher(**kwargs)
+            for size in get_sizes(self.rng, 8, 3 * lock_files.CHUNK_SIZE):
+                data = os.urandom(size)
+                password = 'pw{}'.format(self.rng.randrange(1000))
+                ciphertext = cipher.encrypt(password, data)
+                self.assertEqual(cipher.is_binary(ciphertext), cipher.m_binary, self.msg)
+                self.assertEqual(bytes(cipher.decrypt(password, ciphertext)), data,
+                                 '{} {} {}'.format(kwargs, size, self.msg))
+
+    def test_salt(self):
+        '''
+        The same data is encrypted differently each time.
+        '''
+        for kwargs in FORMATS:
+            cipher = lock_files.AESCipher(**kwargs)
+            self.assertNotEqual(cipher.encrypt('pw', b'data'), cipher.encrypt('pw', b'data'))
+
+    def test_wrong_password(self):
+        '''
+        The binary format detects a wrong password.
+        '''
+        cipher = lock_files.AESCipher(kdf='pbkdf2', cost=1000)
+        ciphertext = cipher.encrypt('secret', b'data')
+        with self.assertRaises(ValueError):
+            cipher.decrypt('wrong', ciphertext)
+
+    def test_kdf_cost_limit(self):
+        '''
+        A header that asks for a KDF cost above the limits is rejected
+        before the KDF runs.
+        '''
+        cipher = lock_files.AESCipher(kdf='scrypt', cost=10)
+        ciphertext = cipher.encrypt('secret', b'data')
+        for cost, r, p in [(21, 8, 1), (20, 8, 2), (10, 0, 1), (0xffffffff, 8, 1)]:
+            header = bytearray(ciphertext[:cipher.m_binary_header_len])
+            header[6:10] = cost.to_bytes(4, 'big')
+            header[10], header[11] = r, p
+            with self.assertRaises(ValueError):
+                cipher.decrypt('secret', bytes(header) + ciphertext[len(header):])
+        self.assertFalse(lock_files.is_kdf_cost_valid('pbkdf2', lock_files.KDF_MAX_PBKDF2_ITER + 1))
+
+    def test_bad_padding(self):
+        '''
+        The other formats detect a wrong password by the padding, for
+        all but about one file in 256.
+        '''
+        for kwargs in [{}, {'openssl': True}]:
+            cipher = lock_files.AESCipher(**kwargs)
+            failed = 0
+            for _ in range(100):
+                try:
+                    cipher.decrypt('wrong', cipher.encrypt('secret', b'data'))
+                except ValueError:
+                    failed += 1
+            self.assertGreater(failed, 90)
+
+    def test_content_hash(self):
+        '''
+        Changing a byte of the ciphertext is detected by the content
+        hash or the padding.
+        '''
+        cipher = lock_files.AESCipher(kdf='pbkdf2', cost=1000, hash='sha256')
+        data = os.urandom(1000)
+        ciphertext = bytearray(cipher.encrypt('pw', data))
+        ciphertext[cipher.m_binary_header_len + self.rng.randrange(len(ciphertext) - cipher.m_binary_header_len)] ^= 0x01
+        with self.assertRaises(ValueError, msg=self.msg):
+            cipher.decrypt('pw', bytes(ciphertext))
+
+    def test_stream_equivalence(self):
+        '''
+        The stream encryptor and decryptor interoperate with the in
+        memory functions for any chunking of the data.
+        '''
+        for kwargs in FORMATS:
+            cipher = lock_files.AESCipher(**kwargs)
+            for size in get_sizes(self.rng, 3, 3 * lock_files.CHUNK_SIZE):
+                data = os.urandom(size)
+                ciphertext = stream(lock_files.AESStreamEncryptor(cipher, 'pw'), data, self.rng)
+                self.assertEqual(bytes(cipher.decrypt('pw', ciphertext)), data,
+                                 '{} {} {}'.format(kwargs, size, self.msg))
+                ciphertext = cipher.encrypt('pw', data)
+                self.assertEqual(stream(lock_files.AESStreamDecryptor(cipher, 'pw'), ciphertext, self.rng), data,
+                                 '{} {} {}'.format(kwargs, size, self.msg))
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'openssl is not available')
+class TestOpensslCompatibility(PropertyTestCase):
+    '''
+    Test that the openssl compatible formats interoperate with the
+    openssl command.
+    '''
+    def openssl(self, args, data):
+        '''
+        Run openssl enc with the data as its input.
+        '''
+        cmd = ['openssl', 'enc', '-aes-256-cbc', '-a', '-A', '-pass', 'pass:secret'] + args
+        proc = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        return proc.stdout
+
+    def check(self, cipher, args):
+        '''
+        Check both directions for random sizes.
+        '''
+        for size in get_sizes(self.rng, 4, 64 * 1024):
+            data = os.urandom(size)
+            self.assertEqual(self.openssl(['-d'] + args, cipher.encrypt('secret', data)), data, self.msg)
+            self.assertEqual(bytes(cipher.decrypt('secret', self.openssl(['-e'] + args, data))), data, self.msg)
+
+    def test_md5(self):
+        '''
+        The default openssl format: the md5 EVP_BytesToKey KDF.
+        '''
+        self.check(lock_files.AESCipher(openssl=True), ['-md', 'md5'])
+
+    def test_pbkdf2(self):
+        '''
+        The openssl -pbkdf2 format.
+        '''
+        cipher = lock_files.AESCipher(openssl=True, kdf='pbkdf2', cost=1000)
+        self.check(cipher, ['-pbkdf2', '-iter', '1000', '-md', 'sha256'])
+
+
+class TestWriteFile(PropertyTestCase):
+    '''
+    Test the line wrapping of the output.
+    '''
+    def setUp(self):
+        '''
+        Create a temporary directory.
+        '''
+        PropertyTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.opts = get_opts()
+
+    def tearDown(self):
+        '''
+        Remove the temporary directory.
+        '''
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content, width):
+        '''
+        Write the content and return what was written.
+        '''
+        path = os.path.join(self.tmpdir, 'out')
+        stats = lock_files.BatchStats()
+        self.assertTrue(lock_files.write_file(self.opts, path, content, stats, width))
+        self.assertEqual(stats['written'], len(content))
+        with open(path, 'rb') as ifp:
+            return ifp.read()
+
+    def test_wrapping(self):
+        '''
+        The lines have the width, except the last one, and they join
+        up to the content. The output is the same as the output of
+        the LineWriter for any chunking.
+        '''
+        for _ in range(50):
+            content = os.urandom(self.rng.randrange(1, 16 * 1024)).hex().encode('ascii')
+            width = self.rng.choice([1, 7, 64, 76, self.rng.randrange(1, 1000)])
+            data = self.write(content, width)
+            lines = data.split(b'\n')
+            self.assertEqual(lines[-1], b'', self.msg)
+            self.assertTrue(all(len(line) == width for line in lines[:-2]), self.msg)
+            self.assertTrue(0 < len(lines[-2]) <= width, self.msg)
+            self.assertEqual(b''.join(lines), content, self.msg)
+
+            ofp = io.BytesIO()
+            writer = lock_files.LineWriter(ofp, width)
+            i = 0
+            while i < len(content):
+                num = self.rng.randrange(1, 4 * width + 2)
+                writer.write(content[i:i+num])
+                i += num
+            writer.close()
+            self.assertEqual(ofp.getvalue(), data, self.msg)
+
+    def test_no_wrapping(self):
+        '''
+        A width of 0 writes the content as is.
+        '''
+        content = os.urandom(1000)
+        self.assertEqual(self.write(content, 0), content)
+
+    def test_exclusive(self):
+        '''
+        An exclusive write does not replace an existing file unless
+        --warn or --overwrite was specified.
+        '''
+        path = os.path.join(self.tmpdir, 'out')
+        with open(path, 'wb') as ofp:
+            ofp.write(b'keep')
+        with unittest.mock.patch.object(lock_files, 'err') as error:
+            self.assertFalse(lock_files.write_file(get_opts(), path, b'new', lock_files.BatchStats(), exclusive=True))
+        self.assertEqual(error.call_count, 1)
+        with open(path, 'rb') as ifp:
+            self.assertEqual(ifp.read(), b'keep')
+        for arg in ('-W', '-o'):
+            self.assertTrue(lock_files.write_file(get_opts(arg), path, arg.encode(), lock_files.BatchStats(), exclusive=True))
+            with open(path, 'rb') as ifp:
+                self.assertEqual(ifp.read(), arg.encode())
+
+
+class TestTraversal(PropertyTestCase):
+    '''
+    Test the scanning, scheduling, batching and sharding of the files.
+    '''
+    def setUp(self):
+        '''
+        Create a random tree of files.
+        '''
+        PropertyTestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = []
+        self.hidden = []
+        dirs = [self.tmpdir]
+        for i in range(200):
+            parent = self.rng.choice(dirs)
+            if self.rng.random() < 0.1:
+                path = os.path.join(parent, 'Dir{}'.format(i))
+                os.mkdir(path)
+                dirs.append(path)
+                continue
+            name = self.rng.choice(['File{}.txt', 'file{}.bin', '.hidden{}'])
+            path = os.path.join(parent, name.format(i))
+            with open(path, 'wb') as ofp:
+                ofp.write(os.urandom(self.rng.randrange(2 * lock_files.SMALL_FILE_SIZE)))
+            (self.hidden if name.startswith('.') else self.files).append(path)
+
+    def tearDown(self):
+        '''
+        Remove the tree.
+        '''
+        shutil.rmtree(self.tmpdir)
+
+    def scan(self, *args):
+        '''
+        Scan the tree with the options.
+        '''
+        opts = get_opts(*(list(args) + [self.tmpdir]))
+        return list(lock_files.scan(opts, {'dirs': 0}, True)), opts
+
+    def test_scan(self):
+        '''
+        A recursive scan finds every file that is not hidden once with
+        its size, in case-insensitive name order in each directory.
+        '''
+        entries, _ = self.scan('-r')
+        self.assertEqual(sorted(path for path, _ in entries), sorted(self.files), self.msg)
+        for path, size in entries:
+            self.assertEqual(size, os.path.getsize(path))
+        top = [os.path.basename(path) for path, _ in entries if os.path.dirname(path) == self.tmpdir]
+        self.assertEqual(top, sorted(top, key=str.lower), self.msg)
+
+    def test_no_recurse(self):
+        '''
+        Without -r only the files of the directory are found.
+        '''
+        entries, _ = self.scan()
+        expected = [path for path in self.files if os.path.dirname(path) == self.tmpdir]
+        self.assertEqual(sorted(path for path, _ in entries), sorted(expected), self.msg)
+
+    def test_symlink(self):
+        '''
+        Symbolic links to directories are not followed.
+        '''
+        os.symlink(self.tmpdir, os.path.join(self.tmpdir, 'loop'))
+        entries, _ = self.scan('-r')
+        self.assertEqual(len(entries), len(self.files))
+
+    def test_schedule(self):
+        '''
+        Every policy returns every file once, size returns them
+        largest first and auto starts with the largest file for each
+        worker.
+        '''
+        entries, _ = self.scan('-r')
+        for policy in ['name', 'size', 'auto']:
+            opts = get_opts('-r', '-j', '4', '--schedule', policy, self.tmpdir)
+            ordered = list(lock_files.schedule(opts, iter(entries)))
+            self.assertEqual(sorted(ordered), sorted(entries), policy)
+            sizes = [size for _, size in ordered]
+            if policy == 'size':
+                self.assertEqual(sizes, sorted(sizes, reverse=True))
+            if policy == 'auto':
+                self.assertEqual(sorted(sizes[:4], reverse=True), sorted(sizes, reverse=True)[:4])
+
+    def test_batch(self):
+        '''
+        The batches have every file once, in the order of the
+        schedule, and respect the limits.
+        '''
+        entries, _ = self.scan('-r')
+        self.rng.shuffle(entries)
+        batches = list(lock_files.batch(iter(entries)))
+        self.assertEqual([item for items in batches for item in items], entries)
+        for items in batches:
+            if len(items) > 1:
+                self.assertTrue(all(size <= lock_files.SMALL_FILE_SIZE for _, size in items))
+                self.assertLessEqual(len(items), lock_files.BATCH_FILES)
+                self.assertLess(sum(size for _, size in items[:-1]), lock_files.BATCH_BYTES)
+
+    def test_shards(self):
+        '''
+        The shards, by hash or by plan, are disjoint and cover every
+        file.
+        '''
+        count = self.rng.randrange(2, 6)
+        for plan in [[], ['--shard-plan', os.path.join(self.tmpdir, '.plan.json')]]:
+            found = []
+            for index in range(1, count + 1):
+                entries, _ = self.scan('-r', '--shard', '{}/{}'.format(index, count), *plan)
+                found.extend(path for path, _ in entries)
+            self.assertEqual(sorted(found), sorted(self.files), self.msg)
+
+    def test_shard_key(self):
+        '''
+        A file and its locked versions belong to the same shard.
+        '''
+        opts = get_opts('--shard', '1/3')
+        for path in self.files:
+            key = lock_files.get_shard_key(opts, self.tmpdir, path)
+            self.assertFalse(key.startswith('/'))
+            for locked in [path + '.locked', path + '.locked.locked']:
+                self.assertEqual(lock_files.get_shard_key(opts, self.tmpdir, locked), key)
+
+    def test_shard_plan(self):
+        '''
+        The plan is within the LPT bound: no shard has more than the
+        average load plus the largest file.
+        '''
+        for _ in range(20):
+            count = self.rng.randrange(1, 8)
+            entries = [('k{}'.format(i), None, self.rng.randrange(1 << 20)) for i in range(self.rng.randrange(1, 100))]
+            plan = lock_files.make_shard_plan(entries, count)
+            loads = [0] * count
+            for key, _, size in entries:
+                loads[plan[key]] += size
+            total = sum(size for _, _, size in entries)
+            self.assertLessEqual(max(loads), total / count + max(size for _, _, size in entries), self.msg)
+
+
+@unittest.skipIf(not PERF, 'set LOCK_FILES_PERF=1 to run the performance tier')
+class TestPerf(unittest.TestCase):
+    '''
+    Compare the throughput and the peak memory of the cipher and the
+    traversal paths with the stored baseline.
+
+    The throughput is the best of several runs to reduce the noise. It
+    is stored relative to a reference operation measured in the same
+    run, raw AES-CBC for the cipher and plain file operations for the
+    files, so that the baseline does not depend on the machine. The
+    peak memory is measured with tracemalloc relative to the size of
+    the data.
+    '''
+    results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        '''
+        Record the baseline if it was requested.
+        '''
+        if PERF == 'record' and cls.results:
+            baseline = {
+                'version': 2,
+                'tolerance': {'throughput': 0.5, 'memory': 0.25},
+                'metrics': cls.results,
+            }
+            with open(BASELINE, 'w') as ofp:
+                json.dump(baseline, ofp, indent=2, sort_keys=True)
+                ofp.write('\n')
+
+    def check(self, name, value, higher_is_better):
+        '''
+        Compare a metric with the baseline.
+        '''
+        self.results[name] = round(value, 3)
+        if PERF == 'record':
+            return
+        if not os.path.exists(BASELINE):
+            self.skipTest('no baseline, record one with LOCK_FILES_PERF=record')
+        with open(BASELINE) as ifp:
+            baseline = json.load(ifp)
+        expected = baseline['metrics'].get(name)
+        if expected is None:
+            self.skipTest('no baseline for {}'.format(name))
+        if higher_is_better:
+            limit = expected * (1 - baseline['tolerance']['throughput'])
+            self.assertGreaterEqual(value, limit, '{} regressed: {:.3f} < {:.3f} (baseline {})'.format(name, value, limit, expected))
+        else:
+            limit = expected * (1 + baseline['tolerance']['memory'])
+            self.assertLessEqual(value, limit, '{} regressed: {:.3f} > {:.3f} (baseline {})'.format(name, value, limit, expected))
+
+    def best(self, fct, runs=5):
+        '''
+        The shortest time of several runs of the function.
+        '''
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            fct()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def peak(self, fct):
+        '''
+        The peak traced memory of the function.
+        '''
+        tracemalloc.start()
+        try:
+            fct()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_cipher_throughput(self):
+        '''
+        The throughput of the in memory and stream paths relative to
+        raw AES-CBC on the same data.
+        '''
+        size = 8 * 1024 * 1024
+        data = os.urandom(size)
+
+        def raw(mode):
+            cipher = lock_files.Cipher(lock_files.algorithms.AES(bytes(32)), lock_files.modes.CBC(bytes(16)),
+                                       backend=lock_files.default_backend())
+            context = cipher.encryptor() if mode == 'encrypt' else cipher.decryptor()
+            context.update(data)
+            context.finalize()
+        reference = {mode: self.best(lambda: raw(mode)) for mode in ['encrypt', 'decrypt']}
+        for kwargs, name in [({}, 'legacy'), ({'kdf': 'pbkdf2', 'cost': 1000}, 'binary')]:
+            cipher = lock_files.AESCipher(**kwargs)
+            ciphertext = cipher.encrypt('pw', data)
+            self.check('encrypt_{}_vs_aes'.format(name), reference['encrypt'] / self.best(lambda: cipher.encrypt('pw', data)), True)
+            self.check('decrypt_{}_vs_aes'.format(name), reference['decrypt'] / self.best(lambda: cipher.decrypt('pw', ciphertext)), True)
+
+            def encrypt_stream():
+                target = lock_files.AESStreamEncryptor(cipher, 'pw')
+                for i in range(0, size, lock_files.CHUNK_SIZE):
+                    target.update(data[i:i+lock_files.CHUNK_SIZE])
+                target.finalize()
+                target.close()
+            self.check('stream_encrypt_{}_vs_aes'.format(name), reference['encrypt'] / self.best(encrypt_stream), True)
+
+    def test_cipher_memory(self):
+        '''
+        The peak memory of the in memory paths relative to the size
+        of the data.
+        '''
+        size = 8 * 1024 * 1024
+        data = os.urandom(size)
+        cipher = lock_files.AESCipher()
+        ciphertext = cipher.encrypt('pw', data)  # warm up the pool
+        self.check('encrypt_peak_ratio', self.peak(lambda: cipher.encrypt('pw', data)) / size, False)
+        self.check('decrypt_peak_ratio', self.peak(lambda: cipher.decrypt('pw', ciphertext)) / size, False)
+
+    def test_small_files(self):
+        '''
+        The time to lock and unlock small files relative to reading,
+        writing and removing them, and the time to scan them relative
+        to os.walk() and os.stat().
+        '''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            num = 1000
+            for i in range(num):
+                with open(os.path.join(tmpdir, 'f{}'.format(i)), 'wb') as ofp:
+                    ofp.write(os.urandom(1024))
+            lock_files.th_budget = lock_files.MemoryBudget(1 << 30)
+
+            def copy_files():
+                for name in os.listdir(tmpdir):
+                    path = os.path.join(tmpdir, name)
+                    with open(path, 'rb') as ifp:
+                        data = ifp.read()
+                    with open(path + '.copy', 'wb') as ofp:
+                        ofp.write(data)
+                    os.remove(path + '.copy')
+            best = {}
+            for _ in range(3):  # copy, lock and unlock cycles, the best of each
+                best['copy'] = min(best.get('copy', float('inf')), self.best(copy_files, 1))
+                for action in ['lock', 'unlock']:
+                    opts = get_opts('--' + action, tmpdir)
+                    entries = list(lock_files.scan(opts, {'dirs': 0}, True))
+                    stats = lock_files.BatchStats()
+                    start = time.perf_counter()
+                    for path, size in entries:
+                        lock_files.process_file(opts, 'pw', path, stats, size)
+                    seconds = time.perf_counter() - start
+                    self.assertEqual(stats[action + 'ed'], num)
+                    best[action] = min(best.get(action, seconds), seconds)
+            for action in ['lock', 'unlock']:
+                self.check('{}_files_vs_copy'.format(action), best['copy'] / best[action], True)
+
+            def walk_files():
+                for root, _, names in os.walk(tmpdir):
+                    for name in names:
+                        os.stat(os.path.join(root, name))
+            opts = get_opts('-r', tmpdir)
+            reference = self.best(walk_files)
+            self.check('scan_files_vs_walk', reference / self.best(lambda: list(lock_files.scan(opts, {'dirs': 0}, True))), True)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()